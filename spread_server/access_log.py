@@ -0,0 +1,241 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+import os
+from bisect import bisect_left
+from collections import deque
+from time import time
+
+import flask
+
+from mo_dots import coalesce
+from mo_files import File
+from mo_json import value2json
+from mo_kwargs import override
+from mo_logs import Log
+from mo_threads import Lock, Signal, Thread, Till
+from mo_times.dates import Date
+
+DEBUG = False
+MAX_DATA = 10000  # CHARACTERS OF REQUEST BODY TO KEEP
+LATENCY_BUCKETS = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10]  # UPPER BOUNDS, IN SECONDS
+START = "spread_server.start"  # environ KEY FOR REQUEST START TIME
+DETAILS = "spread_server.details"  # environ KEY FOR (query, data, error) GIVEN TO record_request
+
+
+class AccessLog(object):
+    """
+    REQUEST THREADS ONLY PUT RAW VALUES IN A BOUNDED BUFFER (DROPPING, AND COUNTING, WHAT DOES NOT FIT)
+    A BACKGROUND THREAD MAKES THE JSON AND WRITES IT TO A ROTATING JSON-LINES FILE
+    """
+
+    @override
+    def __init__(
+        self,
+        filename,
+        max_records=10000,
+        batch_size=1000,
+        flush_seconds=1,
+        max_bytes=100 * 2 ** 20,
+        backups=5,
+        kwargs=None,
+    ):
+        """
+        :param filename: JSON-LINES FILE TO WRITE
+        :param max_records: SIZE OF BUFFER; RECORDS ARE DROPPED WHEN THE WRITER FALLS BEHIND
+        :param batch_size: WRITE EARLY IF THIS MANY RECORDS ARE WAITING
+        :param flush_seconds: MAXIMUM SECONDS A RECORD WAITS TO BE WRITTEN
+        :param max_bytes: ROTATE THE FILE WHEN IT GETS THIS BIG
+        :param backups: NUMBER OF ROTATED FILES TO KEEP (filename.1 IS NEWEST)
+        """
+        self.settings = kwargs
+        self.file = File(filename)
+        self.max_records = max_records
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+        self.locker = Lock("access log")
+        self.buffer = deque()
+        self.dropped = 0
+        self.written = 0
+        self.latency = {}  # MAP FROM endpoint TO Histogram
+        self.batch_ready = Signal()
+        self.writer = Thread.run("access log writer", self._writer)
+
+    def before_request(self):
+        flask.request.environ[START] = time()
+
+    def after_request(self, response):
+        """
+        CALLED BY flask ON THE REQUEST THREAD: NO SERIALIZATION HERE
+        LATENCY IS TIME TO RESPONSE, NOT INCLUDING ANY STREAMED BODY
+        """
+        request = flask.request
+        try:
+            now = time()
+            environ = request.environ
+            latency = now - environ.get(START, now)
+            query, data, error = environ.get(DETAILS, (None, None, None))
+            headers = request.headers
+            record = (
+                now,
+                latency,
+                request.method,
+                request.full_path,
+                request.endpoint,
+                response.status_code,
+                headers.get("user_agent"),
+                headers.get("accept_encoding"),
+                headers.get("x-referer"),
+                headers.get("content_length"),
+                coalesce(headers.get("x-remote-addr"), request.remote_addr),
+                headers.get("from"),
+                query,
+                data,
+                error,
+            )
+            with self.locker:
+                histogram = self.latency.get(request.endpoint)
+                if histogram is None:
+                    histogram = self.latency[request.endpoint] = Histogram(LATENCY_BUCKETS)
+                histogram.add(latency)
+                if len(self.buffer) >= self.max_records:
+                    self.dropped += 1
+                else:
+                    self.buffer.append(record)
+                    if len(self.buffer) >= self.batch_size:
+                        self.batch_ready.go()
+        except Exception as cause:
+            Log.warning("Can not record", cause=cause)
+        return response
+
+    def metrics(self):
+        with self.locker:
+            return {
+                "pending": len(self.buffer),
+                "dropped": self.dropped,
+                "written": self.written,
+                "latency": {k: v.data() for k, v in self.latency.items()},
+            }
+
+    def _writer(self, please_stop):
+        try:
+            while not please_stop:
+                (Till(seconds=self.flush_seconds) | self.batch_ready | please_stop).wait()
+                self._flush()
+        finally:
+            self._flush()
+
+    def _flush(self):
+        with self.locker:
+            records, self.buffer = self.buffer, deque()
+            self.batch_ready = Signal()
+        if not records:
+            return
+        try:
+            lines = "".join(value2json(_to_json(r)) + "\n" for r in records).encode("utf8")
+            self.file.parent.create()
+            path = self.file.os_path
+            if os.path.exists(path) and os.path.getsize(path) + len(lines) > self.max_bytes:
+                self._rotate()
+            with open(path, "ab") as output:
+                output.write(lines)
+            with self.locker:
+                self.written += len(records)
+            DEBUG and Log.note("wrote {{num}} access log records", num=len(records))
+        except Exception as cause:
+            with self.locker:
+                self.dropped += len(records)
+            Log.warning("Can not write access log {{file}}", file=self.file.abs_path, cause=cause)
+
+    def _rotate(self):
+        path = self.file.os_path
+        for i in range(self.backups, 0, -1):
+            older = f"{path}.{i}"
+            newer = f"{path}.{i - 1}" if i > 1 else path
+            if os.path.exists(newer):
+                os.replace(newer, older)
+        if not self.backups:
+            os.remove(path)
+
+    def stop(self):
+        self.writer.stop().join()
+
+
+class Histogram(object):
+    """
+    COUNT OF VALUES FALLING UNDER EACH BUCKET BOUND (LAST COUNT IS FOR LARGER VALUES)
+    """
+
+    __slots__ = ["bounds", "counts", "total", "max"]
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def data(self):
+        count = sum(self.counts)
+        return {
+            "count": count,
+            "mean": self.total / count if count else 0,
+            "max": self.max,
+            "buckets": {
+                **{str(b): c for b, c in zip(self.bounds, self.counts)},
+                "inf": self.counts[-1],
+            },
+        }
+
+
+def _to_json(record):
+    (
+        timestamp,
+        latency,
+        method,
+        path,
+        endpoint,
+        status,
+        user_agent,
+        accept_encoding,
+        referer,
+        content_length,
+        remote_addr,
+        from_,
+        query,
+        data,
+        error,
+    ) = record
+    if isinstance(data, bytes):
+        data = data[:MAX_DATA].decode("utf8", "replace")
+    elif data:
+        data = data[:MAX_DATA]
+    return {
+        "timestamp": Date(timestamp),
+        "latency": latency,
+        "method": method,
+        "path": path,
+        "endpoint": endpoint,
+        "status": status,
+        "http_user_agent": user_agent,
+        "http_accept_encoding": accept_encoding,
+        "referer": referer,
+        "content_length": content_length,
+        "remote_addr": remote_addr,
+        "from": from_,
+        "query_text": value2json(query) if query else None,
+        "data": data if data else None,
+        "error": value2json(error) if error else None,
+    }
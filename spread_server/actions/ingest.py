@@ -0,0 +1,62 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+import flask
+from flask import Response
+
+from mo_files import TempFile, mimetype
+from mo_json import value2json
+from mo_logs import Except
+from mo_threads.threads import register_thread
+from pyLibrary.env.flask_wrappers import cors_wrapper
+from spread_server.ingest import merge, split_table_name, verify
+
+UPLOAD_CHUNK = 2 ** 16
+
+
+@cors_wrapper
+@register_thread
+def ingest(table):
+    """
+    ACCEPT A SHARD (A sqlite FILE) AND MERGE IT INTO THE LOCAL DATABASE
+    EXPECTS ?key=<column>&shard=<number>&shards=<number>, WHICH MUST MATCH THE NODE'S ingest CONFIG
+    :param table: FULL TABLE NAME, LIKE "chinook.employees"
+    :return: JSON WITH NUMBER OF ROWS ADDED
+    """
+    args = flask.request.args
+    try:
+        _, name = split_table_name(table)
+        key = args["key"]
+        shard, shards = int(args["shard"]), int(args["shards"])
+        if not 0 <= shard < shards:
+            raise ValueError("shard out of range")
+    except Exception as cause:
+        return _json({"error": "expecting key, shard and shards parameters", "cause": Except.wrap(cause)}, 400)
+    app = flask.current_app
+    if (shard, shards) != (app.shard, app.shards):
+        return _json(
+            {"error": "this node holds a different shard", "shard": app.shard, "shards": app.shards}, 400
+        )
+
+    with TempFile() as upload:
+        with open(upload.os_path, "wb") as output:
+            while True:
+                chunk = flask.request.stream.read(UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                output.write(chunk)
+
+        misplaced = verify(upload, name, key, shard, shards)
+        if misplaced:
+            return _json({"error": "rows do not belong on this shard", "misplaced": misplaced}, 400)
+        rows = merge(upload, table)
+    return _json({"table": table, "rows": rows}, 200)
+
+
+def _json(value, status):
+    return Response(value2json(value), status, headers={"Content-Type": mimetype.JSON})
@@ -8,6 +8,7 @@
 #
 from __future__ import absolute_import, division, unicode_literals
 
+import flask
 from flask import Response
 from mo_json import value2json
 
@@ -17,10 +18,12 @@ from mo_threads.threads import register_thread
 from pyLibrary.env.flask_wrappers import cors_wrapper, use_data
 from mo_sql_parsing import parse
 
-from spread_server.dispatch import execute
+from spread_server.dispatch import is_claimed
+from spread_server.dispatch.jobs import RUNNING
+from spread_server.dispatch.scatter import split_query
+from spread_server.profiling import is_profiling
 
-HOST = URL("http://localhost:5000/responses")
-RESPONSE_DIRECTORY = File("spread_server/responses")
+RESPONSE_DIRECTORY = File("spread_server/responses")  # DEFAULT, WHEN THE CONFIG HAS NO response_directory
 
 
 @cors_wrapper
@@ -29,13 +32,96 @@ RESPONSE_DIRECTORY = File("spread_server/responses")
 def sql(data):
     # validate
     try:
-        parse(data)
+        query = parse(data)
+        if flask.current_app.coordinator:
+            # REJECT WHAT CAN NOT BE SPREAD OVER THE NODES NOW, NOT WHEN THE JOB RUNS
+            split_query(query)
     except Exception as cause:
         return Response(value2json(cause), 400, headers={"Content-Type": mimetype.JSON})
 
-    name = f"{randoms.base64(20)}.sqlite"
+    host = URL(flask.request.host_url)
+    cache = flask.current_app.result_cache
+    id = cache.key(query) if cache else None
+    if id:
+        found = cache.get(id)
+        if found:
+            _, rows = found
+            result = str(host / "response" / f"{id}.sqlite")
+            return Response(
+                value2json({"id": id, "status": str(host / "status" / id), "result": result, "rows": rows}),
+                200,
+                headers={"Content-Type": mimetype.JSON, "Location": result},
+            )
+    else:
+        id = randoms.filename()
+    name = f"{id}.sqlite"
     # define new database file
-    output_file = RESPONSE_DIRECTORY / name
-    execute(data, output_file)
+    output_file = flask.current_app.response_directory / name
+    scheduler = flask.current_app.scheduler
+    if is_profiling(flask.request):
+        # RUN ON THIS THREAD, SO THE PROFILE INCLUDES THE QUERY
+        rows = scheduler.executor(query, output_file)
+        result = str(host / "response" / name)
+        return Response(
+            value2json({"id": id, "status": str(host / "status" / id), "result": result, "rows": rows}),
+            200,
+            headers={"Content-Type": mimetype.JSON, "Location": result},
+        )
+    job = scheduler.submit(id, query, output_file)
+    if job is None:
+        return Response(
+            value2json({"error": "too many queries waiting, try again later"}),
+            429,
+            headers={"Content-Type": mimetype.JSON, "Retry-After": str(scheduler.retry_after())},
+        )
 
-    return Response(None, 201, headers={"Location": HOST / name})
+    result = str(host / "response" / name)
+    status = str(host / "status" / id)
+    return Response(
+        value2json({"id": id, "status": status, "result": result}),
+        202,
+        # THE RESULT DOES NOT EXIST YET; THE STATUS SAYS WHEN IT DOES
+        headers={"Content-Type": mimetype.JSON, "Location": status},
+    )
+
+
+@cors_wrapper
+@register_thread
+def status(id):
+    """
+    :param id: THE JOB ID GIVEN BY sql()
+    :return: JSON DESCRIBING THE PROGRESS OF THE QUERY
+    """
+    job = flask.current_app.scheduler.get(id)
+    if job is None:
+        cache = flask.current_app.result_cache
+        if cache and id in cache:
+            return Response(
+                value2json({"id": id, "status": "done", "rows": cache.rows(id)}),
+                200,
+                headers={"Content-Type": mimetype.JSON},
+            )
+        if is_claimed(flask.current_app.response_directory / f"{id}.sqlite"):
+            # RUNNING IN ANOTHER WORKER PROCESS
+            return Response(
+                value2json({"id": id, "status": RUNNING}), 200, headers={"Content-Type": mimetype.JSON},
+            )
+        return Response(value2json({"error": "unknown job"}), 404, headers={"Content-Type": mimetype.JSON})
+    return Response(value2json(job), 200, headers={"Content-Type": mimetype.JSON})
+
+
+@cors_wrapper
+@register_thread
+def metrics():
+    """
+    :return: JSON WITH THE COUNTERS OF THIS SERVER (RESULT CACHE HITS AND MISSES, ACCESS LOG)
+    """
+    app = flask.current_app
+    return Response(
+        value2json({
+            "result_cache": app.result_cache.metrics() if app.result_cache else None,
+            "access_log": app.access_log.metrics() if app.access_log else None,
+        }),
+        200,
+        headers={"Content-Type": mimetype.JSON},
+    )
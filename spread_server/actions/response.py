@@ -6,17 +6,25 @@
 #
 # Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
 #
+import os
+from urllib.parse import quote
 
 import flask
-from flask import send_from_directory
+from flask import Response
+from werkzeug.security import safe_join
 
-from mo_files import File
+from mo_files import mimetype
+from mo_http.big_data import ibytes2icompressed
+from mo_json import value2json
 from mo_logs import Log
 from mo_threads.threads import register_thread
 from pyLibrary.env.flask_wrappers import cors_wrapper
 from spread_server.actions import record_request
 
-RESPONSE_DIRECTORY = File("spread_server/responses")
+DOWNLOAD_CHUNK = 2 ** 16
+COMPRESS = False  # GZIP FULL DOWNLOADS FOR CLIENTS THAT ACCEPT IT (COSTS CPU, SAVES NETWORK)
+SENDFILE = None  # "X-Accel-Redirect" (nginx) OR "X-Sendfile" (apache, lighttpd) TO LET THE FRONT SERVER SEND THE FILE
+ACCEL_LOCATION = "/internal/responses/"  # nginx internal LOCATION THAT MAPS TO THE RESPONSE DIRECTORY
 
 
 @cors_wrapper
@@ -24,11 +32,86 @@ RESPONSE_DIRECTORY = File("spread_server/responses")
 def download(filename):
     """
     DOWNLOAD FILE CONTENTS
+    SUPPORTS Range, If-Range AND If-None-Match SO CLIENTS CAN RESUME, AND SKIP UNCHANGED RESULTS
     :param filename:  URL PATH
     :return: Response OBJECT WITH FILE CONTENT
     """
     try:
-        record_request(flask.request, None, flask.request.get_data(), None)
-        return send_from_directory(RESPONSE_DIRECTORY.abs_path, filename, as_attachment=True)
+        request = flask.request
+        record_request(request, None, request.get_data(), None)
+        directory = flask.current_app.response_directory.abs_path
+        path = safe_join(directory, filename)
+        if path is None or not os.path.isfile(path):
+            return Response(value2json({"error": "unknown result"}), 404, headers={"Content-Type": mimetype.JSON})
+
+        # RESULT FILES ARE NEVER CHANGED IN PLACE, SO SIZE AND TIME IDENTIFY THE CONTENT
+        stat = os.stat(path)
+        size = stat.st_size
+        etag = f"{size:x}-{stat.st_mtime_ns:x}"
+        gzip = COMPRESS and not request.range and request.accept_encodings["gzip"] > 0
+        if gzip:
+            etag += "-gzip"
+        headers = {
+            "ETag": f'"{etag}"',
+            "Accept-Ranges": "bytes",
+            "Content-Type": "application/octet-stream",
+            "Content-Disposition": f"attachment; filename*=UTF-8''{quote(os.path.basename(path))}",
+        }
+        if COMPRESS:
+            headers["Vary"] = "Accept-Encoding"
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+
+        if SENDFILE == "X-Accel-Redirect":
+            headers[SENDFILE] = ACCEL_LOCATION + quote(os.path.relpath(path, directory))
+            return Response(status=200, headers=headers)
+        elif SENDFILE:
+            headers[SENDFILE] = path
+            return Response(status=200, headers=headers)
+
+        if gzip:
+            headers["Content-Encoding"] = "gzip"
+            return Response(ibytes2icompressed(_read(path, 0, size)), 200, headers=headers, direct_passthrough=True)
+
+        byte_range = _byte_range(request, etag)
+        if byte_range and len(byte_range.ranges) == 1:
+            span = byte_range.range_for_length(size)
+            if span is None:
+                headers["Content-Range"] = f"bytes */{size}"
+                return Response(status=416, headers=headers)
+            start, stop = span
+            headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+            headers["Content-Length"] = str(stop - start)
+            return Response(_read(path, start, stop), 206, headers=headers, direct_passthrough=True)
+
+        headers["Content-Length"] = str(size)
+        return Response(_read(path, 0, size), 200, headers=headers, direct_passthrough=True)
     except Exception as cause:
         Log.error("Could not get file {{file}}", file=filename, cause=cause)
+
+
+def _byte_range(request, etag):
+    """
+    :return: THE REQUESTED Range, IF STILL VALID FOR THIS VERSION OF THE FILE
+    """
+    if not request.range:
+        return None
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None:
+        # ONLY STRONG (ETag) VALIDATION
+        return None
+    return request.range
+
+
+def _read(path, start, stop):
+    with open(path, "rb") as file:
+        file.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = file.read(min(DOWNLOAD_CHUNK, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
@@ -7,12 +7,14 @@
 # Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
 #
 import os
+import sys
 import threading
 
 import flask
 from flask import Flask, Response
 from werkzeug.serving import make_server
 
+from mo_dots import coalesce, to_data
 from mo_files import File
 from mo_future import text
 from mo_kwargs import override
@@ -20,7 +22,14 @@ from mo_logs import Log, constants, machine_metadata, startup
 from mo_threads import stop_main_thread
 from mo_threads.threads import MAIN_THREAD, register_thread, wait_for_shutdown_signal
 from pyLibrary.env.flask_wrappers import cors_wrapper, add_version, setup_flask_ssl
-from spread_server.actions import static, response, query
+from spread_server.access_log import AccessLog
+from spread_server.actions import static, response, query, ingest
+from spread_server.dispatch import execute
+from spread_server.dispatch.cache import ResultCache
+from spread_server.dispatch.jobs import Scheduler
+from spread_server.dispatch.scatter import Coordinator
+from spread_server.profiling import ProfileMiddleware
+from spread_server.supervisor import RequestCounter, Supervisor, listen_socket, report_metrics
 
 APP_NAME = "SpreadServer"
 OVERVIEW = "You have reached the spread server (https://github.com/klahnakoski/spread-server)"
@@ -29,6 +38,14 @@ config = None
 
 
 class SpreadServerApp(Flask):
+    scheduler = None  # THE Scheduler RUNNING THIS APP'S QUERIES
+    result_cache = None  # THE ResultCache OF FINISHED QUERIES (NOT IN COORDINATOR MODE)
+    coordinator = None  # THE Coordinator, IN COORDINATOR MODE
+    response_directory = None  # File WHERE RESULT DATABASES ARE WRITTEN
+    shard = 0  # THE SHARD THIS NODE HOLDS, FROM THE ingest CONFIG
+    shards = 1  # NUMBER OF SHARDS IN THE CLUSTER, FROM THE ingest CONFIG
+    access_log = None  # THE AccessLog, IF CONFIGURED
+
     def run(self, *args, **kwargs):
         # ENSURE THE LOGGING IS CLEANED UP
         try:
@@ -45,21 +62,58 @@ class SpreadServerApp(Flask):
             stop_main_thread()
 
     def process_response(self, response):
+        # RUNS THE after_request HOOKS (ACCESS LOG, REQUEST COUNTER) AND SAVES THE SESSION
+        response = Flask.process_response(self, response)
         del response.headers["Date"]
         del response.headers["Server"]
         return response
 
 
-def setup_flask(flask_app, flask_config):
+def setup_flask(flask_app, flask_config, app_config=None):
+    """
+    :param flask_app: THE SpreadServerApp
+    :param flask_config: THE flask SETTINGS
+    :param app_config: FULL CONFIGURATION (DEFAULT IS THE GLOBAL config)
+    """
+    flask_config = to_data(flask_config)
+    app_config = to_data(coalesce(app_config, config))
+
     @flask_app.route("/", defaults={"path": ""}, methods=["OPTIONS", "HEAD"])
     @flask_app.route("/<path:path>", methods=["OPTIONS", "HEAD"])
     @cors_wrapper
     def _head(path):
         return Response(b"", status=200)
 
+    flask_app.response_directory = File(
+        coalesce(app_config.response_directory, query.RESPONSE_DIRECTORY.abs_path)
+    )
+    flask_app.shard = coalesce(app_config.ingest.shard, 0)
+    flask_app.shards = coalesce(app_config.ingest.shards, 1)
+    if not 0 <= flask_app.shard < flask_app.shards:
+        Log.error(
+            "Expecting ingest.shard in [0, {{shards}}), not {{shard}}", shard=flask_app.shard, shards=flask_app.shards
+        )
+    if app_config.coordinator:
+        # COORDINATOR MODE: QUERIES ARE SPREAD OVER THE NODES
+        # NODE DATA VERSIONS ARE NOT KNOWN HERE, SO NO RESULT CACHE
+        flask_app.coordinator = Coordinator(kwargs=app_config.coordinator)
+        executor = flask_app.coordinator.execute
+    else:
+        flask_app.result_cache = ResultCache(directory=flask_app.response_directory.abs_path, kwargs=app_config.cache)
+        executor = flask_app.result_cache.wrap(execute)
+    flask_app.scheduler = Scheduler(executor=executor, kwargs=app_config.scheduler)
+    if app_config.access_log:
+        flask_app.access_log = AccessLog(kwargs=app_config.access_log)
+        flask_app.before_request(flask_app.access_log.before_request)
+        flask_app.after_request(flask_app.access_log.after_request)
     flask_app.add_url_rule("/query/sql", None, query.sql, methods=["POST"])
+    flask_app.add_url_rule("/status", None, query.metrics)
+    flask_app.add_url_rule("/status/<id>", None, query.status)
     flask_app.add_url_rule("/response/<path:filename>", None, response.download)
+    flask_app.add_url_rule("/ingest/<path:table>", None, ingest.ingest, methods=["POST"])
     flask_app.add_url_rule("/favicon.ico", None, static.send_favicon)
+    # ONLY ACTS WHEN spread_server.profiling.PROFILE IS SET
+    flask_app.wsgi_app = ProfileMiddleware(flask_app.wsgi_app)
 
     add_version(flask_app, "https://github.com/klahnakoski/spread-server/tree")
 
@@ -71,8 +125,8 @@ def setup_flask(flask_app, flask_config):
     def _default(path):
         return Response(OVERVIEW, status=200, headers={"Content-Type": "text/html"})
 
-    if flask_config.port and config.args.process_num:
-        flask_config.port += config.args.process_num
+    if flask_config.port and app_config.args.process_num:
+        flask_config.port += app_config.args.process_num
 
     # TURN ON /exit FOR WINDOWS DEBUGGING
     if flask_config.debug or flask_config.allow_exit:
@@ -81,7 +135,7 @@ def setup_flask(flask_app, flask_config):
         flask_app.add_url_rule("/exit", "exit", _exit)
 
     if flask_config.ssl_context:
-        if config.args.process_num:
+        if app_config.args.process_num:
             Log.error("can not serve ssl and multiple Flask instances at once")
         setup_flask_ssl(APP_NAME, flask_app, flask_config)
 
@@ -103,8 +157,15 @@ def _exit():
 
 
 class ServerThread(threading.Thread):
-    def __init__(self, host, port, app, **kwargs):
+    def __init__(self, host, port, app, reuse_port=False, **kwargs):
+        """
+        :param reuse_port: True TO SHARE THE PORT WITH OTHER PROCESSES (SO_REUSEPORT)
+        """
         threading.Thread.__init__(self)
+        self.socket = None
+        if reuse_port:
+            self.socket = listen_socket(host, port)
+            kwargs["fd"] = self.socket.fileno()
         self.srv = override(make_server)(host, port, app, **kwargs)
         self.ctx = app.app_context()
         self.ctx.push()
@@ -118,9 +179,13 @@ class ServerThread(threading.Thread):
             self.srv.shutdown()
         except Exception:
             pass
+        if self.socket:
+            self.socket.close()
+
 
+def main():
+    global config
 
-if __name__ in ("__main__", "spread_server.app"):
     try:
         config = startup.read_config(
             default_filename=os.environ.get("SPREAD_SERVER_CONFIG"),
@@ -131,20 +196,46 @@ if __name__ in ("__main__", "spread_server.app"):
                 "dest": "process_num",
                 "default": 0,
                 "required": False,
+            }, {
+                "name": ["--worker"],
+                "help": "Run as worker of the supervisor (sharing its port)",
+                "type": int,
+                "dest": "worker",
+                "default": None,
+                "required": False,
             }],
         )
 
         constants.set(config.constants)
         Log.start(config.debug)
 
-        File.new_instance(f"{APP_NAME}.pid").write(text(machine_metadata().pid))
+        worker = config.args.worker is not None
+        if not worker:
+            File.new_instance(f"{APP_NAME}.pid").write(text(machine_metadata().pid))
 
         # MAKE FLASK TALK LESS TO logging
         import logging
 
         logging.getLogger("werkzeug").setLevel(logging.ERROR)
 
-        if config.flask:
+        if config.flask and config.supervisor and not worker:
+            # WORKERS ARE THIS SAME PROGRAM, WITH THE SAME ARGUMENTS
+            supervisor = Supervisor(params=[sys.executable] + sys.argv, kwargs=config.supervisor)
+            wait_for_shutdown_signal(allow_exit=True)
+            supervisor.stop()
+        elif config.flask and worker:
+            flask_app = SpreadServerApp(__name__)
+            setup_flask(flask_app, config.flask)
+            counter = RequestCounter()
+            flask_app.after_request(counter.after_request)
+            reporter = report_metrics(flask_app, counter, coalesce(config.supervisor.report_seconds, 1))
+
+            server_thread = ServerThread(app=flask_app, reuse_port=True, **config.flask)
+            server_thread.start()
+            wait_for_shutdown_signal(allow_exit=True)
+            server_thread.stop()
+            reporter.stop()
+        elif config.flask:
             flask_app = SpreadServerApp(__name__)
             setup_flask(flask_app, config.flask)
 
@@ -155,3 +246,7 @@ if __name__ in ("__main__", "spread_server.app"):
     except BaseException as cause:  # MUST CATCH BaseException BECAUSE argparse LIKES TO EXIT THAT WAY, AND gunicorn WILL NOT REPORT
         Log.error("Serious problem with SpreadServer service construction!  Shutdown!", cause=cause)
         stop_main_thread()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,9 +6,227 @@
 #
 # Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
 #
+import os
+import re
+import sqlite3
+from urllib.parse import quote as url_quote
+
+from mo_dots import is_data, is_list
+from mo_files import File
+from mo_future import is_text
+from mo_logs import Log
+from mo_math import randoms
+from mo_sql import SQL, SQL_AS, SQL_CREATE, ConcatSQL
+from mo_sql_parsing import format as format_sql, parse
+from mo_sqlite import Sqlite, quote_column, quote_value
+from mo_threads import Till
+from mo_times import Timer
+
+DEBUG = False
+DATA_DIRECTORY = "spread_server/data"  # WHERE THE LOCAL {name}.sqlite DATABASES ARE FOUND
+CLAIM_WAIT = 0.1  # SECONDS BETWEEN LOOKS AT A RESULT ANOTHER WRITER HAS CLAIMED
+RESULT_TABLE = "result"
+
+_database_name = re.compile(r"^[_a-zA-Z][_0-9a-zA-Z]*$")
+_reserved_names = {"main", "temp"}
 
 
 def execute(sql, output_file):
-    # attach required databases
-    # rephrase as create table of new database
-    pass
+    """
+    RUN sql AGAINST THE LOCAL DATABASES, PUT RESULT IN NEW DATABASE
+    :param sql: SQL TEXT, OR THE mo_sql_parsing TREE
+    :param output_file: File WHERE THE RESULT DATABASE WILL BE WRITTEN, WITH ONE TABLE CALLED "result"
+    :return: NUMBER OF ROWS IN THE RESULT
+    """
+    if is_text(sql):
+        sql = parse(sql)
+    databases = required_databases(sql)
+
+    def fill(db):
+        # attach required databases
+        # rephrase as create table of new database
+        for name, file in databases.items():
+            attach(db, name, file)
+        db.query(ConcatSQL(SQL_CREATE, quote_column(RESULT_TABLE), SQL_AS, SQL(format_sql(sql))))
+
+    return write_result(output_file, fill)
+
+
+def write_result(output_file, fill):
+    """
+    MAKE A NEW RESULT DATABASE
+    WORKERS SHARE THE RESPONSE DIRECTORY, AND THE SAME QUERY GETS THE SAME id, SO THE FIRST WRITER CLAIMS THE
+    RESULT; THE OTHERS WAIT FOR IT, AND REUSE IT
+    :param output_file: File WHERE THE RESULT DATABASE WILL BE WRITTEN
+    :param fill: FUNCTION GIVEN THE (EMPTY) Sqlite DATABASE, WHICH MUST CREATE THE "result" TABLE
+    :return: NUMBER OF ROWS IN THE RESULT
+    """
+    output_file = File(output_file)
+    output_file.parent.create()
+    claim = claim_file(output_file)
+    while not _claim(claim):
+        while is_claimed(output_file):
+            Till(seconds=CLAIM_WAIT).wait()
+        if output_file.exists:
+            return _result_rows(output_file)
+        # THE OTHER WRITER FAILED, SO WE TRY
+
+    try:
+        # NEVER TOUCH ANOTHER WRITER'S PARTIAL
+        partial_file = File(f"{output_file.abs_path}.{os.getpid()}.{randoms.filename()}.partial")
+        with Timer("write result to {{file}}", param={"file": output_file.abs_path}, verbose=DEBUG):
+            try:
+                db = Sqlite(db=sqlite3.connect(
+                    partial_file.os_path, check_same_thread=False, isolation_level=None, uri=True
+                ))
+                try:
+                    # RESULT IS WRITTEN ONCE; IF WE CRASH WE START OVER
+                    db.query("PRAGMA journal_mode=OFF")
+                    db.query("PRAGMA synchronous=OFF")
+                    fill(db)
+                    # NEW TABLE HAS DENSE rowid, SO NO NEED TO SCAN
+                    rows = db.query(ConcatSQL(
+                        SQL("SELECT coalesce(max(rowid), 0) FROM "), quote_column(RESULT_TABLE)
+                    )).data[0][0]
+                finally:
+                    db.stop()
+            except Exception as cause:
+                partial_file.delete()
+                Log.error("Can not execute query", cause=cause)
+
+        # ONLY A COMPLETE RESULT IS VISIBLE UNDER output_file
+        os.replace(partial_file.os_path, output_file.os_path)
+        return rows
+    finally:
+        claim.delete()
+
+
+def claim_file(output_file):
+    """
+    :return: File THAT EXISTS WHILE SOME WRITER IS MAKING output_file
+    """
+    return File(File(output_file).abs_path + ".claim")
+
+
+def is_claimed(output_file):
+    """
+    :return: True IF A LIVE WRITER IS MAKING output_file (A CLAIM LEFT BY A DEAD PROCESS IS REMOVED)
+    """
+    claim = claim_file(output_file)
+    try:
+        with open(claim.os_path, "r") as f:
+            pid = int(f.read() or 0)
+    except FileNotFoundError:
+        return False
+    except ValueError:
+        # CLAIMED, BUT pid NOT WRITTEN YET
+        return True
+    if _is_alive(pid):
+        return True
+    claim.delete()
+    return False
+
+
+def _claim(claim):
+    """
+    :return: True IF WE ARE NOW THE ONLY WRITER
+    """
+    try:
+        fd = os.open(claim.os_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w") as f:
+        f.write(str(os.getpid()))
+    return True
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def _result_rows(output_file):
+    db = sqlite3.connect(_read_only_uri(output_file), uri=True)
+    try:
+        return db.execute(str(ConcatSQL(
+            SQL("SELECT coalesce(max(rowid), 0) FROM "), quote_column(RESULT_TABLE)
+        ))).fetchone()[0]
+    finally:
+        db.close()
+
+
+def attach(db, name, file):
+    """
+    ATTACH file, READ-ONLY, TO db UNDER GIVEN name
+    """
+    db.query(ConcatSQL(SQL("ATTACH DATABASE "), quote_value(_read_only_uri(file)), SQL_AS, quote_column(name)))
+
+
+def detach(db, name):
+    db.query(ConcatSQL(SQL("DETACH DATABASE "), quote_column(name)))
+
+
+def required_databases(sql):
+    """
+    :param sql: mo_sql_parsing TREE
+    :return: MAP FROM DATABASE NAME TO LOCAL DATABASE File
+    """
+    output = {}
+    for table in set(_table_names(sql)):
+        path = table.split(".")
+        if len(path) < 2:
+            continue
+        name = path[0]
+        if name in output:
+            continue
+        if not is_database_name(name):
+            Log.error("Not allowed to use database {{name|quote}}", name=name)
+        file = File(DATA_DIRECTORY) / f"{name}.sqlite"
+        if not file.exists:
+            Log.error("Unknown database {{name|quote}}", name=name)
+        output[name] = file
+    return output
+
+
+def is_database_name(name):
+    """
+    :return: True IF name CAN BE USED AS A LOCAL DATABASE
+    """
+    return name not in _reserved_names and bool(_database_name.match(name))
+
+
+def to_file(value):
+    """
+    :param value: PATH, OR File (INCLUDING TempDirectory AND TempFile, WHICH File() DOES NOT ACCEPT)
+    :return: THE File
+    """
+    return value if isinstance(value, File) else File(value)
+
+
+def _table_names(tree, is_from=False):
+    """
+    YIELD THE TABLE NAMES FOUND IN ALL from CLAUSES (INCLUDING JOINS AND SUB-QUERIES)
+    """
+    if is_text(tree):
+        if is_from:
+            yield tree
+    elif is_list(tree):
+        for t in tree:
+            yield from _table_names(t, is_from)
+    elif is_data(tree):
+        for k, v in tree.items():
+            if k == "from":
+                yield from _table_names(v, True)
+            elif is_from and (k == "value" or k.endswith("join")):
+                yield from _table_names(v, True)
+            else:
+                yield from _table_names(v)
+
+
+def _read_only_uri(file):
+    return "file:" + url_quote(file.abs_path) + "?mode=ro"
@@ -0,0 +1,235 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+import os
+from collections import OrderedDict
+from hashlib import sha256
+
+from mo_dots import is_data, is_list
+from mo_future import is_text
+from mo_kwargs import override
+from mo_logs import Log
+from mo_sql_parsing import format as format_sql, parse
+from mo_threads import Lock
+
+from spread_server.dispatch import required_databases, to_file
+
+DEBUG = False
+RESULT_EXTENSION = ".sqlite"
+# SQL FUNCTIONS WHOSE VALUE DOES NOT DEPEND ONLY ON THE DATA, SO RESULTS USING THEM ARE NOT CACHED
+NON_DETERMINISTIC = {
+    "random",
+    "randomblob",
+    "changes",
+    "last_insert_rowid",
+    "total_changes",
+    "date",
+    "time",
+    "datetime",
+    "julianday",
+    "strftime",
+    "unixepoch",
+    "timediff",
+}
+# SAME, BUT WRITTEN WITHOUT PARENTHESES, SO THEY LOOK LIKE COLUMN NAMES IN THE PARSED TREE
+NON_DETERMINISTIC_KEYWORDS = {"current_date", "current_time", "current_timestamp"}
+
+
+class ResultCache(object):
+    """
+    RESULT FILES ARE NAMED BY THE HASH OF THE (NORMALIZED) QUERY AND THE VERSION OF
+    EVERY DATABASE IT READS, SO AN EXISTING FILE IS ALWAYS A CORRECT ANSWER
+    """
+
+    @override
+    def __init__(self, directory, max_bytes=10 * 2 ** 30, kwargs=None):
+        """
+        :param directory: WHERE RESULT FILES ARE KEPT
+        :param max_bytes: LEAST RECENTLY USED FILES ARE DELETED TO STAY UNDER THIS SIZE
+        """
+        self.settings = kwargs
+        self.directory = to_file(directory)
+        self.max_bytes = max_bytes
+        self.locker = Lock("result cache")
+        self.entries = OrderedDict()  # MAP FROM id TO (size, rows), LEAST RECENTLY USED FIRST
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._scan()
+
+    def key(self, query):
+        """
+        :param query: SQL TEXT, OR THE mo_sql_parsing TREE
+        :return: id FOR THE RESULT, OR None IF query CAN NOT BE CACHED
+        """
+        if is_text(query):
+            query = parse(query)
+        try:
+            databases = required_databases(query)
+        except Exception as cause:
+            # LET THE JOB REPORT THE PROBLEM
+            DEBUG and Log.note("Not caching query", cause=cause)
+            return None
+        if not databases or _is_non_deterministic(query):
+            # NO DATABASE VERSION TO KEY ON, OR A DIFFERENT ANSWER EVERY TIME
+            return None
+        # format() OF THE TREE IGNORES WHITESPACE, CASE AND COMMENTS OF THE ORIGINAL TEXT
+        acc = sha256(format_sql(query).encode("utf8"))
+        for name in sorted(databases):
+            acc.update(f"\n{name}:{data_version(databases[name])}".encode("utf8"))
+        return acc.hexdigest()[:40]
+
+    def file(self, id):
+        return self.directory / f"{id}{RESULT_EXTENSION}"
+
+    def get(self, id):
+        """
+        :return: (File, rows) IF THE RESULT IS READY, OR None
+        """
+        with self.locker:
+            entry = self.entries.get(id) or self._adopt(id)
+            if entry is None:
+                self.misses += 1
+                return None
+            if not os.path.exists(self.file(id).os_path):
+                # DELETED BY SOMEONE ELSE
+                self._forget(id)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(id)
+            self.hits += 1
+            return self.file(id), entry[1]
+
+    def __contains__(self, id):
+        """
+        CHECK FOR RESULT, WITHOUT COUNTING A HIT OR MISS
+        """
+        with self.locker:
+            if id not in self.entries:
+                return self._adopt(id) is not None
+            return os.path.exists(self.file(id).os_path)
+
+    def rows(self, id):
+        """
+        :return: ROW COUNT OF A CACHED RESULT, WITHOUT COUNTING A HIT, OR None
+        """
+        with self.locker:
+            entry = self.entries.get(id)
+            return None if entry is None else entry[1]
+
+    def add(self, id, rows):
+        """
+        REMEMBER A NEW RESULT, AND EVICT OLD ONES IF WE ARE TOO BIG
+        """
+        size = os.path.getsize(self.file(id).os_path)
+        with self.locker:
+            self._forget(id)
+            self.entries[id] = (size, rows)
+            self.bytes += size
+            self._evict()
+
+    def wrap(self, executor):
+        """
+        :param executor: FUNCTION(query, output_file) THAT RUNS THE QUERY
+        :return: SAME, BUT REMEMBERS THE RESULT
+        """
+
+        def execute(query, output_file):
+            rows = executor(query, output_file)
+            self.add(to_file(output_file).stem, rows)
+            return rows
+
+        return execute
+
+    def metrics(self):
+        with self.locker:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "files": len(self.entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _forget(self, id):
+        entry = self.entries.pop(id, None)
+        if entry:
+            self.bytes -= entry[0]
+
+    def _adopt(self, id):
+        """
+        A RESULT WRITTEN BY ANOTHER PROCESS SHARING THIS DIRECTORY (eg SUPERVISOR WORKERS)
+        :return: THE NEW ENTRY, OR None
+        """
+        try:
+            size = os.path.getsize(self.file(id).os_path)
+        except FileNotFoundError:
+            return None
+        entry = self.entries[id] = (size, None)
+        self.bytes += size
+        self._evict()
+        return entry
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            id, (size, _) = self.entries.popitem(last=False)
+            self.bytes -= size
+            DEBUG and Log.note("Evict result {{id}} ({{size}} bytes)", id=id, size=size)
+            try:
+                # OPEN DOWNLOADS CAN STILL READ THE UNLINKED FILE
+                os.remove(self.file(id).os_path)
+            except FileNotFoundError:
+                pass
+
+    def _scan(self):
+        """
+        ADOPT RESULTS FROM BEFORE RESTART, OLDEST FIRST
+        """
+        if not os.path.isdir(self.directory.os_path):
+            return
+        found = []
+        for name in os.listdir(self.directory.os_path):
+            if not name.endswith(RESULT_EXTENSION):
+                continue
+            stat = os.stat(os.path.join(self.directory.os_path, name))
+            found.append((stat.st_mtime, name[: -len(RESULT_EXTENSION)], stat.st_size))
+        with self.locker:
+            for _, id, size in sorted(found):
+                self.entries[id] = (size, None)
+                self.bytes += size
+            self._evict()
+
+
+def data_version(file):
+    """
+    :return: STRING THAT CHANGES WHEN THE DATABASE file CHANGES
+    """
+    acc = []
+    for suffix in ("", "-wal"):
+        try:
+            stat = os.stat(to_file(file).os_path + suffix)
+            acc.append(f"{stat.st_size:x}.{stat.st_mtime_ns:x}")
+        except FileNotFoundError:
+            acc.append("-")
+    return "/".join(acc)
+
+
+def _is_non_deterministic(tree):
+    """
+    :return: True IF THE mo_sql_parsing tree CALLS ANY OF THE NON_DETERMINISTIC FUNCTIONS
+    """
+    if is_text(tree):
+        # A COLUMN NAMED date IS FINE; ONLY date(...) IS A CALL, AND THAT IS A KEY
+        return tree.lower() in NON_DETERMINISTIC_KEYWORDS
+    elif is_list(tree):
+        return any(_is_non_deterministic(t) for t in tree)
+    elif is_data(tree):
+        return any(
+            k.lower() in NON_DETERMINISTIC or (k != "literal" and _is_non_deterministic(v)) for k, v in tree.items()
+        )
+    return False
@@ -0,0 +1,161 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from collections import deque
+
+from mo_kwargs import override
+from mo_logs import Log, Except
+from mo_math import ceiling
+from mo_threads import Lock, Queue, Thread, THREAD_STOP
+from mo_times.dates import Date
+
+from spread_server.dispatch import execute
+
+DEBUG = False
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class Job(object):
+    """
+    ONE QUERY, AND WHAT WE KNOW ABOUT ITS PROGRESS
+    """
+
+    def __init__(self, id, query, output_file):
+        self.id = id
+        self.query = query
+        self.output_file = output_file
+        self.status = QUEUED
+        self.rows = None
+        self.error = None
+        self.submitted = Date.now()
+        self.started = None
+        self.ended = None
+
+    @property
+    def queue_time(self):
+        if self.started is None:
+            return (Date.now() - self.submitted).seconds
+        return (self.started - self.submitted).seconds
+
+    @property
+    def run_time(self):
+        if self.started is None:
+            return None
+        if self.ended is None:
+            return (Date.now() - self.started).seconds
+        return (self.ended - self.started).seconds
+
+    def __data__(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "rows": self.rows,
+            "submitted": self.submitted,
+            "started": self.started,
+            "ended": self.ended,
+            "queue_time": self.queue_time,
+            "run_time": self.run_time,
+            "error": self.error,
+        }
+
+
+class Scheduler(object):
+    """
+    RUN QUERY JOBS ON A BOUNDED POOL OF WORKER THREADS
+    """
+
+    @override
+    def __init__(self, workers=4, max_pending=100, max_history=1000, executor=None, kwargs=None):
+        """
+        :param executor: FUNCTION(query, output_file) THAT RUNS THE QUERY (DEFAULT dispatch.execute)
+        :param workers: NUMBER OF QUERIES TO RUN AT ONCE
+        :param max_pending: NUMBER OF QUERIES ALLOWED TO WAIT; MORE ARE REJECTED
+        :param max_history: NUMBER OF FINISHED JOBS TO REMEMBER FOR STATUS REQUESTS
+        """
+        self.settings = kwargs
+        self.executor = executor or execute
+        self.max_pending = max_pending
+        self.max_history = max_history
+        self.locker = Lock("scheduler")
+        self.jobs = {}  # MAP FROM id TO Job
+        self.history = deque()  # FINISHED JOBS, OLDEST FIRST
+        self.total_run_time = 0
+        self.total_finished = 0
+        self.queue = Queue("query jobs", max=max_pending, silent=True)
+        self.workers = [Thread.run(f"query worker {i}", self._worker) for i in range(workers)]
+
+    def submit(self, id, query, output_file):
+        """
+        :return: Job, OR None IF THERE ARE TOO MANY QUERIES WAITING
+        """
+        with self.locker:
+            job = self.jobs.get(id)
+            if job is not None and job.status in (QUEUED, RUNNING):
+                # SAME RESULT IS ALREADY COMING
+                return job
+            if len(self.queue) >= self.max_pending:
+                return None
+            job = Job(id, query, output_file)
+            self.jobs[id] = job
+            self.queue.add(job)
+        return job
+
+    def get(self, id):
+        with self.locker:
+            return self.jobs.get(id)
+
+    def retry_after(self):
+        """
+        :return: SECONDS A REJECTED CLIENT SHOULD WAIT BEFORE TRYING AGAIN
+        """
+        with self.locker:
+            if not self.total_finished:
+                return 1
+            mean_run_time = self.total_run_time / self.total_finished
+        return max(1, ceiling(mean_run_time * len(self.queue) / max(1, len(self.workers))))
+
+    def _worker(self, please_stop):
+        while not please_stop:
+            job = self.queue.pop(till=please_stop)
+            if job is None or job is THREAD_STOP:
+                break
+            job.started = Date.now()
+            job.status = RUNNING
+            try:
+                job.rows = self.executor(job.query, job.output_file)
+                job.status = DONE
+            except Exception as cause:
+                job.error = Except.wrap(cause)
+                job.status = FAILED
+                Log.warning("Query job {{id}} failed", id=job.id, cause=job.error)
+            finally:
+                job.ended = Date.now()
+                job.query = None
+                self._retire(job)
+
+    def _retire(self, job):
+        DEBUG and Log.note(
+            "Job {{id}} {{status}} in {{run_time}} seconds", id=job.id, status=job.status, run_time=job.run_time,
+        )
+        with self.locker:
+            self.total_run_time += job.run_time
+            self.total_finished += 1
+            self.history.append(job)
+            while len(self.history) > self.max_history:
+                old = self.history.popleft()
+                self.jobs.pop(old.id, None)
+
+    def stop(self):
+        self.queue.close()
+        for w in self.workers:
+            w.stop()
+        Thread.join_all(self.workers)
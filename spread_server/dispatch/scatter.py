@@ -0,0 +1,334 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from copy import deepcopy
+
+from requests import sessions
+from requests.adapters import HTTPAdapter
+
+from mo_dots import is_data, is_list, listwrap
+from mo_files import File, TempDirectory, URL
+from mo_future import is_text
+from mo_http import http
+from mo_json import json2value
+from mo_kwargs import override
+from mo_logs import Log
+from mo_sql import SQL, SQL_AS, SQL_CREATE, SQL_FROM, SQL_INSERT, SQL_SELECT, SQL_STAR, ConcatSQL
+from mo_sql_parsing import format as format_sql, parse
+from mo_sqlite import quote_column
+from mo_threads import Thread, Till
+from mo_times import Timer
+
+from spread_server.dispatch import RESULT_TABLE, attach, detach, write_result
+
+DEBUG = False
+PARTIAL_TABLE = "partial"  # THE UNION OF ALL SHARD RESULTS, WHICH THE reduce QUERY READS
+SHARD = "shard"
+DOWNLOAD_CHUNK = 2 ** 16
+
+ALL_COLUMNS = parse("SELECT * FROM t")["select"]
+
+# AGGREGATE USED ON SHARDS, AND THE AGGREGATE THAT COMBINES THEIR PARTIAL RESULTS
+PARTIAL_AGGREGATES = {
+    "sum": "sum",
+    "total": "total",
+    "count": "sum",
+    "min": "min",
+    "max": "max",
+}
+AGGREGATES = set(PARTIAL_AGGREGATES.keys()) | {"avg"}
+
+
+def split_query(query):
+    """
+    :param query: mo_sql_parsing TREE
+    :return: (map, reduce) PAIR OF TREES; map IS RUN ON EVERY SHARD, reduce IS RUN ON THE UNION
+             OF ALL map RESULTS, FOUND IN THE PARTIAL_TABLE
+    """
+    query = deepcopy(query)
+    for k in ("union", "union_all", "with", "intersect", "except"):
+        if k in query:
+            Log.error("Can not distribute {{type|upper}} queries", type=k)
+    if "select_distinct" in query:
+        select_key = "select_distinct"
+    elif "select" in query:
+        select_key = "select"
+    else:
+        Log.error("Can only distribute SELECT queries")
+
+    select = _list(query[select_key])
+    # sqlite ALLOWS GROUP BY ON SELECT ALIASES, THE SHARDS NEED THE EXPRESSION
+    aliases = {s["name"]: s["value"] for s in select if not _is_all_columns(s) and s.get("name")}
+    groupby = [
+        aliases.get(g["value"], g["value"]) if is_text(g["value"]) else g["value"]
+        for g in _list(query.get("groupby"))
+    ]
+    orderby = _list(query.get("orderby"))
+    limit, offset = query.get("limit"), query.get("offset")
+
+    is_aggregate = bool(groupby) or "having" in query or any(
+        not _is_all_columns(s) and _has_aggregate(s["value"]) for s in select
+    )
+    if is_aggregate:
+        # SHARDS GROUP AND CALCULATE PARTIAL AGGREGATES, REDUCE COMBINES THEM
+        splitter = _Splitter(groupby)
+        reduce_select = []
+        for i, s in enumerate(select):
+            if _is_all_columns(s):
+                Log.error("Can not distribute SELECT * with aggregates")
+            reduce_select.append({"value": splitter.rewrite(s["value"]), "name": _column_name(s)})
+        reduce_query = {select_key: reduce_select, "from": PARTIAL_TABLE}
+        if groupby:
+            reduce_query["groupby"] = [{"value": g["name"]} for g in splitter.groups]
+        outputs = [s["name"] for s in reduce_select]
+        if "having" in query:
+            reduce_query["having"] = splitter.rewrite(query["having"], outputs)
+        if orderby:
+            reduce_query["orderby"] = [dict(o, value=splitter.rewrite(o["value"], outputs)) for o in orderby]
+
+        map_query = {"select": splitter.groups + splitter.partials, "from": query["from"]}
+        if "where" in query:
+            map_query["where"] = query["where"]
+        if groupby:
+            map_query["groupby"] = [{"value": g} for g in groupby]
+    else:
+        # SHARDS FILTER, REDUCE CONCATENATES (AND RE-SORTS)
+        map_select = [s if _is_all_columns(s) else {"value": s["value"], "name": _column_name(s)} for s in select]
+        map_query = dict(query)
+        map_query[select_key] = map_select
+        map_query.pop("offset", None)
+        if limit is not None:
+            # EACH SHARD NEED ONLY SEND WHAT MAY SURVIVE THE FINAL LIMIT
+            map_query["limit"] = limit + (offset or 0)
+
+        reduce_query = {select_key: ALL_COLUMNS, "from": PARTIAL_TABLE}
+        if orderby:
+            outputs = list(map_select)
+            reduce_query["orderby"] = [dict(o, value=_output_column(o["value"], map_select)) for o in orderby]
+            if len(map_select) > len(outputs):
+                # SHARDS ALSO SEND THE SORT COLUMNS, WHICH THE reduce DOES NOT RETURN
+                if select_key == "select_distinct":
+                    Log.error("Can not distribute SELECT DISTINCT with ORDER BY on columns missing from SELECT")
+                if any(_is_all_columns(s) for s in outputs):
+                    Log.error("Can not distribute SELECT * with ORDER BY on an expression")
+                reduce_query[select_key] = [{"value": s["name"]} for s in outputs]
+
+    if limit is not None:
+        reduce_query["limit"] = limit
+    if offset is not None:
+        reduce_query["offset"] = offset
+    return map_query, reduce_query
+
+
+class _Splitter(object):
+    """
+    REWRITE EXPRESSIONS SO AGGREGATES ARE CALCULATED IN TWO STEPS
+    """
+
+    def __init__(self, groupby):
+        self.groups = [{"value": g, "name": f"_g{i}"} for i, g in enumerate(groupby)]
+        self.partials = []
+
+    def rewrite(self, expr, outputs=()):
+        """
+        :param outputs: NAMES OF reduce COLUMNS THAT expr MAY REFER TO (FOR HAVING AND ORDER BY)
+        """
+        for g in self.groups:
+            if expr == g["value"]:
+                return g["name"]
+        if is_list(expr):
+            return [self.rewrite(e, outputs) for e in expr]
+        if is_text(expr):
+            if expr in outputs:
+                return expr
+            # THE SHARDS DO NOT SEND THIS COLUMN, AND ANY ONE VALUE WOULD BE ARBITRARY
+            Log.error("Can not distribute column {{column|quote}}: it is neither grouped nor aggregated", column=expr)
+        if not is_data(expr) or "literal" in expr:
+            return expr
+        aggregates = [k for k, v in expr.items() if _is_aggregate(k, v)]
+        if aggregates:
+            op = aggregates[0]
+            term = expr[op]
+            if len(expr) > 1 or (is_data(term) and "distinct" in term):
+                Log.error("Can not distribute {{op|upper}} with options {{options}}", op=op, options=expr)
+            return self._aggregate(op, term)
+        return {k: self.rewrite(v, outputs) for k, v in expr.items()}
+
+    def _aggregate(self, op, term):
+        if op == "avg":
+            total = self._partial("sum", term)
+            count = self._partial("count", term)
+            return {"div": [{"total": total}, {"sum": count}]}
+        return {PARTIAL_AGGREGATES[op]: self._partial(op, term)}
+
+    def _partial(self, op, term):
+        value = {op: term}
+        for p in self.partials:
+            if p["value"] == value:
+                return p["name"]
+        name = f"_p{len(self.partials)}"
+        self.partials.append({"value": value, "name": name})
+        return name
+
+
+def _list(value):
+    if value is None:
+        return []
+    if is_list(value):
+        return value
+    return [value]
+
+
+def _has_aggregate(expr):
+    if is_list(expr):
+        return any(_has_aggregate(e) for e in expr)
+    if not is_data(expr) or "literal" in expr:
+        return False
+    return any(_is_aggregate(k, v) or _has_aggregate(v) for k, v in expr.items())
+
+
+def _is_aggregate(op, term):
+    # min(a, b) AND max(a, b) ARE SCALAR FUNCTIONS
+    return op in AGGREGATES and not (is_list(term) and len(term) > 1)
+
+
+def _is_all_columns(select):
+    return select == "*" or select == ALL_COLUMNS or (is_data(select) and "all_columns" in select)
+
+
+def _column_name(select):
+    """
+    NAME OF THE COLUMN sqlite WILL GIVE THE select CLAUSE
+    """
+    if select.get("name"):
+        return select["name"]
+    value = select["value"]
+    if is_text(value):
+        return value.split(".")[-1]
+    return format_sql(value)
+
+
+def _output_column(expr, select):
+    """
+    EXPRESS ORDER BY expr IN TERMS OF THE map OUTPUT COLUMNS
+    :param select: THE map SELECT CLAUSE; A SORT EXPRESSION MISSING FROM IT IS ADDED
+    """
+    if not is_data(expr) and not is_text(expr):
+        return expr  # POSITIONAL
+    for s in select:
+        if not _is_all_columns(s) and (expr == s["value"] or expr == s["name"]):
+            return s["name"]
+    if is_text(expr) and any(_is_all_columns(s) for s in select):
+        return expr.split(".")[-1]
+    name = f"_o{len(select)}"
+    select.append({"value": expr, "name": name})
+    return name
+
+
+class Coordinator(object):
+    """
+    SEND THE map QUERY TO EVERY NODE, AND reduce THEIR RESULTS LOCALLY
+    """
+
+    @override
+    def __init__(self, nodes, timeout=600, poll=0.2, kwargs=None):
+        """
+        :param nodes: LIST OF NODE URLS (eg "http://node1:5000")
+        :param timeout: SECONDS TO WAIT FOR ANY ONE NODE
+        :param poll: SECONDS BETWEEN STATUS REQUESTS
+        """
+        self.settings = kwargs
+        self.nodes = [URL(n) for n in listwrap(nodes)]
+        if not self.nodes:
+            Log.error("Expecting at least one node")
+        self.timeout = timeout
+        self.poll = poll
+        # KEEP CONNECTIONS TO NODES OPEN BETWEEN REQUESTS
+        self.session = sessions.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.nodes), pool_maxsize=max(10, len(self.nodes)))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def execute(self, sql, output_file):
+        """
+        SAME AS dispatch.execute(), BUT OVER ALL NODES
+        """
+        if is_text(sql):
+            sql = parse(sql)
+        map_query, reduce_query = split_query(sql)
+        map_sql = format_sql(map_query)
+        reduce_sql = format_sql(reduce_query)
+
+        with TempDirectory() as temp:
+            partials = [temp / f"{SHARD}{i}.sqlite" for i, _ in enumerate(self.nodes)]
+            with Timer("map {{sql}}", param={"sql": map_sql}, verbose=DEBUG):
+                Thread.join_all([
+                    Thread.run(f"map on {node}", self._map, node, map_sql, partial)
+                    for node, partial in zip(self.nodes, partials)
+                ])
+
+            def fill(db):
+                # TEMP TABLE KEEPS THE PARTIAL RESULTS OUT OF THE OUTPUT FILE
+                for i, partial in enumerate(partials):
+                    attach(db, SHARD, partial)
+                    if i == 0:
+                        db.query(ConcatSQL(
+                            SQL("CREATE TEMP TABLE "), quote_column(PARTIAL_TABLE), SQL_AS,
+                            SQL_SELECT, SQL_STAR, SQL_FROM, quote_column(SHARD, RESULT_TABLE),
+                        ))
+                    else:
+                        db.query(ConcatSQL(
+                            SQL_INSERT, quote_column(PARTIAL_TABLE),
+                            SQL_SELECT, SQL_STAR, SQL_FROM, quote_column(SHARD, RESULT_TABLE),
+                        ))
+                    detach(db, SHARD)
+                db.query(ConcatSQL(SQL_CREATE, quote_column(RESULT_TABLE), SQL_AS, SQL(reduce_sql)))
+
+            with Timer("reduce {{sql}}", param={"sql": reduce_sql}, verbose=DEBUG):
+                return write_result(output_file, fill)
+
+    def _map(self, node, map_sql, partial_file, please_stop):
+        timeout = Till(seconds=self.timeout) | please_stop
+        while True:
+            response = http.post(node / "query/sql", data=map_sql.encode("utf8"), session=self.session)
+            if response.status_code != 429:
+                break
+            wait = float(response.headers.get("Retry-After", self.poll))
+            DEBUG and Log.note("{{node}} is busy, waiting {{wait}} seconds", node=node, wait=wait)
+            (Till(seconds=wait) | timeout).wait()
+            if timeout:
+                Log.error("Timeout waiting for {{node}} to accept query", node=node)
+        if response.status_code not in (200, 202):
+            Log.error(
+                "Node {{node}} did not accept query: {{code}} {{content}}",
+                node=node,
+                code=response.status_code,
+                content=response.content,
+            )
+        job = json2value(response.content.decode("utf8"))
+
+        # 200 MEANS THE NODE ALREADY HAS THE RESULT
+        while response.status_code == 202:
+            status = http.get_json(node / "status" / job.id, session=self.session)
+            if status.status == "done":
+                break
+            if status.status == "failed":
+                Log.error("Node {{node}} failed query", node=node, cause=status.error)
+            (Till(seconds=self.poll) | timeout).wait()
+            if timeout:
+                Log.error("Timeout waiting for {{node}} to finish query", node=node)
+
+        response = http.get(node / "response" / f"{job.id}.sqlite", session=self.session, stream=True)
+        try:
+            if response.status_code != 200:
+                Log.error("Can not download result from {{node}}: {{code}}", node=node, code=response.status_code)
+            with open(File(partial_file).os_path, "wb") as output:
+                for chunk in response.iter_content(DOWNLOAD_CHUNK):
+                    output.write(chunk)
+        finally:
+            response.close()
@@ -0,0 +1,224 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+# ROWS ARE ASSIGNED TO SHARDS WITH JUMP CONSISTENT HASH
+# https://arxiv.org/ftp/arxiv/papers/1406/1406.2294.pdf
+# GROWING FROM M TO M+1 SHARDS MOVES ONLY 1/(M+1) OF THE ROWS, ALL TO THE NEW SHARD
+#
+import os
+import re
+import sqlite3
+from hashlib import blake2b
+
+from mo_files import File
+from mo_future import text
+from mo_logs import Log
+from mo_sql import SQL, SQL_FROM, SQL_INSERT, SQL_SELECT, SQL_WHERE, ConcatSQL, sql_iso, sql_list
+from mo_sqlite import Sqlite, quote_column, quote_value
+from mo_sqlite.database import backup_database
+from mo_threads import Lock
+from mo_times import Timer
+
+from spread_server import dispatch
+from spread_server.dispatch import attach, detach
+
+DEBUG = False
+SHARD_FUNCTION = "shard_of"
+UPLOAD = "upload"
+
+_64_BITS = 0xFFFFFFFFFFFFFFFF
+_column_type = re.compile(r"^[a-zA-Z_][a-zA-Z_ ]*(\(\s*[+-]?\d+\s*(,\s*[+-]?\d+\s*)?\))?$")
+_merge_locks = {}  # MAP FROM DATABASE NAME TO Lock, ONE WRITER AT A TIME
+_merge_locks_lock = Lock("merge locks")
+
+
+def jump_hash(key, buckets):
+    """
+    :param key: 64bit INTEGER
+    :param buckets: NUMBER OF SHARDS
+    :return: SHARD NUMBER IN [0, buckets)
+    """
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & _64_BITS
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def key_hash(value):
+    """
+    STABLE (ACROSS PROCESSES AND MACHINES) 64bit HASH OF A SHARD KEY
+    """
+    if isinstance(value, float) and value.is_integer():
+        # sqlite MAY GIVE 1.0 FOR 1
+        value = int(value)
+    return int.from_bytes(blake2b(text(value).encode("utf8"), digest_size=8).digest(), "big")
+
+
+def shard_of(value, shards):
+    return jump_hash(key_hash(value), shards)
+
+
+def register_functions(db):
+    """
+    ADD shard_of(value, shards) TO THE Sqlite DATABASE
+    """
+    db.db.create_function(SHARD_FUNCTION, 2, shard_of, deterministic=True)
+
+
+def sql_shard_of(key, shards):
+    return ConcatSQL(SQL(SHARD_FUNCTION), sql_iso(sql_list([quote_column(key), quote_value(shards)])))
+
+
+def split_table_name(name):
+    """
+    :param name: FULL TABLE NAME, LIKE "chinook.employees"
+    :return: (database, table) PAIR
+    """
+    path = name.split(".")
+    if len(path) != 2:
+        Log.error("Expecting table name of the form <database>.<table>, not {{name|quote}}", name=name)
+    database, table = path
+    if not dispatch.is_database_name(database):
+        Log.error("Not allowed to use database {{name|quote}}", name=database)
+    return database, table
+
+
+def verify(upload_file, table, key, shard, shards):
+    """
+    :return: NUMBER OF ROWS IN upload_file THAT DO NOT BELONG ON shard
+    """
+    db = Sqlite()
+    try:
+        register_functions(db)
+        attach(db, UPLOAD, upload_file)
+        return db.query(ConcatSQL(
+            SQL_SELECT,
+            SQL("count(1)"),
+            SQL_FROM,
+            quote_column(UPLOAD, table),
+            SQL_WHERE,
+            sql_shard_of(key, shards),
+            SQL(" <> "),
+            quote_value(shard),
+        )).data[0][0]
+    finally:
+        db.stop()
+
+
+def _lock(database):
+    with _merge_locks_lock:
+        return _merge_locks.setdefault(database, Lock(f"merge into {database}"))
+
+
+def snapshot(database, output_file):
+    """
+    PAGE-LEVEL COPY OF THE LOCAL database, FOR restore() ON ANOTHER NODE
+    """
+    if not dispatch.is_database_name(database):
+        Log.error("Not allowed to use database {{name|quote}}", name=database)
+    local = File(dispatch.DATA_DIRECTORY) / f"{database}.sqlite"
+    if not local.exists:
+        Log.error("Unknown database {{name|quote}}", name=database)
+    output_file = File(output_file)
+    output_file.parent.create()
+    partial = File(output_file.abs_path + ".partial")
+    partial.delete()
+    with Timer("snapshot {{name}}", param={"name": database}, verbose=DEBUG):
+        # COPIES A FEW PAGES AT A TIME, SO MERGES AND QUERIES CONTINUE
+        backup_database(local, partial)
+    os.replace(partial.os_path, output_file.os_path)
+
+
+def restore(snapshot_file, database):
+    """
+    REPLACE THE LOCAL database WITH A snapshot()
+    RUNNING QUERIES KEEP READING THE OLD FILE; NEW QUERIES SEE THE RESTORED ONE
+    """
+    if not dispatch.is_database_name(database):
+        Log.error("Not allowed to use database {{name|quote}}", name=database)
+    local = File(dispatch.DATA_DIRECTORY) / f"{database}.sqlite"
+    local.parent.create()
+    partial = File(local.abs_path + ".partial")
+    partial.delete()
+    with _lock(database):
+        with Timer("restore {{name}}", param={"name": database}, verbose=DEBUG):
+            backup_database(snapshot_file, partial)
+            # sqlite FINDS -wal AND -shm BY NAME; THOSE OF THE OLD FILE WOULD BE APPLIED TO THE NEW ONE
+            # NO WRITER CAN MAKE NEW ONES WHILE WE HOLD THE LOCK
+            for suffix in ("-wal", "-shm"):
+                File(local.abs_path + suffix).delete()
+            os.replace(partial.os_path, local.os_path)
+
+
+def merge(upload_file, name):
+    """
+    BULK INSERT ALL ROWS OF upload_file INTO THE LOCAL DATABASE
+    :param upload_file: File WITH THE SHARD TABLE
+    :param name: FULL TABLE NAME, LIKE "chinook.employees"
+    :return: NUMBER OF ROWS ADDED
+    """
+    database, table = split_table_name(name)
+    local = File(dispatch.DATA_DIRECTORY) / f"{database}.sqlite"
+    local.parent.create()
+
+    with _lock(database):
+        with Timer("merge {{table}} into {{file}}", param={"table": table, "file": local.abs_path}, verbose=DEBUG):
+            db = Sqlite(db=sqlite3.connect(
+                local.os_path, check_same_thread=False, isolation_level=None, uri=True
+            ))
+            try:
+                attach(db, UPLOAD, upload_file)
+                columns = db.query(ConcatSQL(
+                    SQL("PRAGMA "), quote_column(UPLOAD, "table_info"), sql_iso(quote_value(table)),
+                )).data
+                if not columns:
+                    Log.error("Expecting upload to have table {{table|quote}}", table=table)
+                exists = db.query(ConcatSQL(
+                    SQL("SELECT count(1) FROM sqlite_master WHERE type='table' AND name="), quote_value(table),
+                )).data[0][0]
+                before = db.query("SELECT total_changes()").data[0][0]
+                with db.transaction() as t:
+                    if not exists:
+                        # THE UPLOAD'S OWN sqlite_master DDL IS NOT TRUSTED; ONLY ITS NAMES, TYPES AND KEYS ARE KEPT
+                        t.execute(_create_table(table, columns))
+                    names = [c[1] for c in columns]
+                    t.execute(ConcatSQL(
+                        SQL_INSERT,
+                        quote_column(table),
+                        sql_iso(sql_list(map(quote_column, names))),
+                        SQL_SELECT,
+                        sql_list(map(quote_column, names)),
+                        SQL_FROM,
+                        quote_column(UPLOAD, table),
+                    ))
+                after = db.query("SELECT total_changes()").data[0][0]
+                detach(db, UPLOAD)
+                return after - before
+            finally:
+                db.stop()
+
+
+def _create_table(table, columns):
+    """
+    :param columns: ROWS OF PRAGMA table_info: (cid, name, type, notnull, dflt_value, pk)
+    :return: CREATE TABLE FOR table WITH THE SAME COLUMN NAMES, TYPES AND PRIMARY KEY
+    """
+    definitions = []
+    for _, name, type_, _, _, _ in columns:
+        if not type_:
+            definitions.append(quote_column(name))
+            continue
+        if not _column_type.match(type_):
+            Log.error("Not allowed to use column type {{type|quote}}", type=type_)
+        definitions.append(ConcatSQL(quote_column(name), SQL(" "), SQL(type_)))
+    primary = [name for _, name, _, _, _, pk in sorted(columns, key=lambda c: c[5]) if pk]
+    if primary:
+        definitions.append(ConcatSQL(SQL("PRIMARY KEY "), sql_iso(sql_list(map(quote_column, primary)))))
+    return ConcatSQL(SQL("CREATE TABLE "), quote_column(table), sql_iso(sql_list(definitions)))
@@ -0,0 +1,238 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+from mo_dots import is_data, is_list, to_data
+from mo_files import URL
+from mo_json import json2value, value2json
+from mo_logs import Log
+from mo_sql import (
+    SQL,
+    SQL_AND,
+    SQL_AS,
+    SQL_EQ,
+    SQL_FROM,
+    SQL_INSERT,
+    SQL_ON,
+    SQL_SELECT,
+    SQL_WHERE,
+    ConcatSQL,
+)
+from mo_sqlite import Sqlite, quote_column, quote_value, sql_insert
+from mo_threads import Thread
+from mo_times import Timer
+
+from spread_server.dispatch import attach, detach, to_file
+from spread_server.ingest import DEBUG, register_functions, shard_of, sql_shard_of
+
+SOURCE = "source"
+SHARD = "shard"
+ASSIGNMENT = "assignment"
+
+
+def shard_database(source, table, key, shards, directory):
+    """
+    SPLIT ONE TABLE OF A sqlite DATABASE INTO shards FILES
+    :param source: THE sqlite DATABASE File
+    :param table: NAME OF TABLE TO SHARD
+    :param key: COLUMN USED TO PICK THE SHARD
+    :param shards: NUMBER OF SHARDS
+    :param directory: WHERE TO PUT THE {table}.{i}.sqlite FILES
+    :return: LIST OF shards Files, IN SHARD ORDER
+    """
+    source, directory = to_file(source), to_file(directory)
+    directory.create()
+    schema = _table_schema(source, table)
+    db = Sqlite()
+    try:
+        register_functions(db)
+        attach(db, SOURCE, source)
+        with Timer("assign {{table}} rows to {{shards}} shards", param={"table": table, "shards": shards}, verbose=DEBUG):
+            # HASH EVERY ROW ONCE, NOT ONCE PER SHARD
+            db.query(ConcatSQL(
+                SQL("CREATE TEMP TABLE "),
+                quote_column(ASSIGNMENT),
+                SQL_AS,
+                SQL_SELECT,
+                SQL("rowid AS r, "),
+                sql_shard_of(key, shards),
+                SQL(" AS s"),
+                SQL_FROM,
+                quote_column(SOURCE, table),
+            ))
+            db.query(ConcatSQL(
+                SQL("CREATE INDEX "), quote_column("temp", ASSIGNMENT + "_s"), SQL(" ON "), quote_column(ASSIGNMENT), SQL("(s, r)")
+            ))
+
+        output = []
+        for i in range(shards):
+            file = directory / f"{table}.{i}.sqlite"
+            file.delete()
+            _create(file, schema)
+            db.query(ConcatSQL(SQL("ATTACH DATABASE "), quote_value(file.abs_path), SQL_AS, quote_column(SHARD)))
+            db.query(ConcatSQL(
+                SQL_INSERT,
+                quote_column(SHARD, table),
+                SQL_SELECT,
+                SQL("t.*"),
+                SQL_FROM,
+                quote_column(SOURCE, table),
+                SQL(" AS t JOIN "),
+                quote_column(ASSIGNMENT),
+                SQL(" AS a"),
+                SQL_ON,
+                SQL("a.r = t.rowid"),
+                SQL_AND,
+                SQL("a.s"),
+                SQL_EQ,
+                quote_value(i),
+            ))
+            detach(db, SHARD)
+            output.append(file)
+        return output
+    finally:
+        db.stop()
+
+
+def shard_lines(lines, table, key, shards, directory, batch_size=1000):
+    """
+    SPLIT A STREAM OF JSON DOCUMENTS INTO shards FILES
+    :param lines: ITERATOR OF JSON (ONE DOCUMENT PER LINE)
+    :param table: NAME OF TABLE TO HOLD THE DOCUMENTS
+    :param key: PROPERTY USED TO PICK THE SHARD
+    :param shards: NUMBER OF SHARDS
+    :param directory: WHERE TO PUT THE {table}.{i}.sqlite FILES
+    :param batch_size: NUMBER OF DOCUMENTS TO INSERT AT ONCE
+    :return: LIST OF shards Files, IN SHARD ORDER
+    """
+    directory = to_file(directory)
+    directory.create()
+    files = [directory / f"{table}.{i}.sqlite" for i in range(shards)]
+    for f in files:
+        f.delete()
+    dbs = [Sqlite(filename=f) for f in files]
+    columns = [None] * shards  # COLUMNS ALREADY IN EACH SHARD TABLE
+    batches = [[] for _ in range(shards)]
+
+    def flush(i):
+        batch, batches[i] = batches[i], []
+        if not batch:
+            return
+        db = dbs[i]
+        with db.transaction() as t:
+            names = {k for row in batch for k in row.keys()}
+            if columns[i] is None:
+                columns[i] = set(names)
+                t.execute(ConcatSQL(
+                    SQL("CREATE TABLE "),
+                    quote_column(table),
+                    SQL("("),
+                    SQL(", ").join(quote_column(c) for c in sorted(names)),
+                    SQL(")"),
+                ))
+            for c in sorted(names - columns[i]):
+                columns[i].add(c)
+                t.execute(ConcatSQL(SQL("ALTER TABLE "), quote_column(table), SQL(" ADD COLUMN "), quote_column(c)))
+            t.execute(sql_insert(table, batch))
+
+    try:
+        for line in lines:
+            if not line.strip():
+                continue
+            doc = json2value(line)
+            row = to_data({k: value2json(v) if is_data(v) or is_list(v) else v for k, v in doc.items()})
+            i = shard_of(doc[key], shards)
+            batches[i].append(row)
+            if len(batches[i]) >= batch_size:
+                flush(i)
+        for i in range(shards):
+            flush(i)
+    finally:
+        for db in dbs:
+            db.stop()
+    return files
+
+
+def send_shards(nodes, files, table, key):
+    """
+    SEND EACH SHARD TO ITS NODE, AT THE SAME TIME
+    :param nodes: LIST OF NODE URLS, IN SHARD ORDER
+    :param files: LIST OF SHARD FILES, IN SHARD ORDER
+    :param table: FULL TABLE NAME ON THE NODES, LIKE "chinook.employees"
+    :param key: THE COLUMN USED TO SHARD
+    :return: LIST OF NODE RESPONSES
+    """
+    from mo_http import http
+
+    if len(nodes) != len(files):
+        Log.error("Expecting one shard per node")
+
+    def send(node, file, shard, please_stop):
+        url = URL(node) / "ingest" / table + {"key": key, "shard": shard, "shards": len(files)}
+        with open(to_file(file).os_path, "rb") as data:
+            response = http.post(url, data=data)
+        content = json2value(response.content.decode("utf8"))
+        if response.status_code != 200:
+            Log.error("Node {{node}} did not accept shard {{shard}}", node=node, shard=shard, cause=content)
+        return content
+
+    return Thread.join_all([
+        Thread.run(f"send shard {i} to {node}", send, node, file, i)
+        for i, (node, file) in enumerate(zip(nodes, files))
+    ])
+
+
+def moved_rows(source, table, key, shards, new_shards, output_file):
+    """
+    EXTRACT THE ROWS OF source THAT MUST MOVE WHEN THE NUMBER OF SHARDS CHANGES
+    WITH JUMP HASH, ONLY ABOUT 1/new_shards OF ROWS MOVE WHEN GROWING BY ONE
+    :return: NUMBER OF ROWS MOVED
+    """
+    source, output_file = to_file(source), to_file(output_file)
+    output_file.delete()
+    _create(output_file, _table_schema(source, table))
+    db = Sqlite()
+    try:
+        register_functions(db)
+        attach(db, SOURCE, source)
+        db.query(ConcatSQL(SQL("ATTACH DATABASE "), quote_value(output_file.abs_path), SQL_AS, quote_column(SHARD)))
+        db.query(ConcatSQL(
+            SQL_INSERT,
+            quote_column(SHARD, table),
+            SQL_SELECT,
+            SQL("*"),
+            SQL_FROM,
+            quote_column(SOURCE, table),
+            SQL_WHERE,
+            sql_shard_of(key, shards),
+            SQL(" <> "),
+            sql_shard_of(key, new_shards),
+        ))
+        return db.query(ConcatSQL(SQL("SELECT count(1) FROM "), quote_column(SHARD, table))).data[0][0]
+    finally:
+        db.stop()
+
+
+def _table_schema(source, table):
+    db = Sqlite(filename=source)
+    try:
+        schema = db.query(ConcatSQL(
+            SQL("SELECT sql FROM sqlite_master WHERE type='table' AND name="), quote_value(table)
+        )).data
+    finally:
+        db.stop()
+    if not schema:
+        Log.error("Expecting {{file}} to have table {{table|quote}}", file=source.abs_path, table=table)
+    return schema[0][0]
+
+
+def _create(file, schema):
+    db = Sqlite(filename=file)
+    try:
+        db.query(schema)
+    finally:
+        db.stop()
@@ -0,0 +1,81 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+import pstats
+from urllib.parse import parse_qs
+
+from mo_logs import Log
+from mo_threads.profile_utils import stats2tab
+from mo_threads.profiles import CProfiler
+
+PROFILE = False  # ALLOW ?profile=1 (OR "X-Profile: 1" HEADER) TO RESPOND WITH THE PROFILE OF THE REQUEST
+PROFILING = "spread_server.profiling"  # environ KEY, True WHILE THE REQUEST IS PROFILED
+
+
+class ProfileMiddleware(object):
+    """
+    WSGI WRAPPER THAT RUNS ONE REQUEST UNDER cProfile, INCLUDING THE
+    STREAMING OF ITS BODY, AND RESPONDS WITH THE stats2tab() TABLE
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if not PROFILE or not wants_profile(environ):
+            return self.wsgi_app(environ, start_response)
+
+        environ[PROFILING] = True
+        status = []
+
+        def capture(code, headers, exc_info=None):
+            status[:] = [code]
+            return lambda data: None
+
+        # NOT USED AS A CONTEXT MANAGER, WHICH WOULD ALSO ADD TO THE PROCESS-WIDE PROFILE
+        profiler = CProfiler()
+        profiler.enable()
+        try:
+            body = self.wsgi_app(environ, capture)
+            try:
+                for _ in body:
+                    pass
+            finally:
+                if hasattr(body, "close"):
+                    body.close()
+        finally:
+            profiler.disable()
+        Log.note(
+            "Profiled {{method}} {{path}} ({{status}})",
+            method=environ.get("REQUEST_METHOD"),
+            path=environ.get("PATH_INFO"),
+            status=status[0] if status else None,
+        )
+        content = stats2tab(pstats.Stats(profiler.cprofiler)).encode("utf8")
+        start_response(
+            "200 OK",
+            [
+                ("Content-Type", "text/tab-separated-values; charset=utf-8"),
+                ("Content-Length", str(len(content))),
+                ("X-Profiled-Status", status[0] if status else ""),
+            ],
+        )
+        return [content]
+
+
+def wants_profile(environ):
+    if environ.get("HTTP_X_PROFILE") == "1":
+        return True
+    return parse_qs(environ.get("QUERY_STRING", "")).get("profile") == ["1"]
+
+
+def is_profiling(request):
+    """
+    :return: True IF THIS flask REQUEST IS BEING PROFILED, SO WORK SHOULD STAY ON THIS THREAD
+    """
+    return bool(request.environ.get(PROFILING))
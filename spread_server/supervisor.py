@@ -0,0 +1,290 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+import os
+import socket
+import sys
+from time import time
+
+import flask
+
+from mo_dots import Null
+from mo_files import File
+from mo_json import json_decoder, value2json
+from mo_kwargs import override
+from mo_logs import Log
+from mo_threads import Lock, Process, Thread, Till
+from mo_threads.threads import stop_main_thread
+
+DEBUG = False
+METRICS_PREFIX = "spread_server.metrics "  # stdout LINES FROM WORKERS THAT CARRY THEIR COUNTERS
+MIN_LIFETIME = 10  # SECONDS; WORKERS DYING YOUNGER THAN THIS ARE RESTARTED WITH INCREASING DELAY
+MAX_RESTART_DELAY = 60  # SECONDS
+
+
+class Supervisor(object):
+    """
+    RUN A NUMBER OF WORKER PROCESSES, EACH A WHOLE SpreadServer (WITH ITS OWN Sqlite
+    CONNECTIONS) LISTENING ON THE SAME SO_REUSEPORT PORT, SO THE KERNEL SPREADS
+    CONNECTIONS OVER THEM.  DEAD (OR SILENT) WORKERS ARE REPLACED.
+    """
+
+    @override
+    def __init__(
+        self,
+        params,
+        workers=None,
+        report_seconds=1,
+        restart_seconds=1,
+        stop_seconds=10,
+        metrics_file=None,
+        kwargs=None,
+    ):
+        """
+        :param params: COMMAND LINE TO START ONE WORKER; "--worker <num>" IS APPENDED
+        :param workers: NUMBER OF WORKER PROCESSES (DEFAULT IS ONE PER CPU)
+        :param report_seconds: HOW OFTEN WORKERS SEND THEIR COUNTERS; A WORKER SILENT FOR 10x THIS IS KILLED
+        :param restart_seconds: WAIT BEFORE REPLACING A DEAD WORKER
+        :param stop_seconds: TIME WORKERS ARE GIVEN TO EXIT BEFORE THEY ARE KILLED
+        :param metrics_file: IF GIVEN, THE COMBINED COUNTERS ARE WRITTEN HERE (AS JSON) EVERY report_seconds
+        """
+        self.settings = kwargs
+        self.params = list(params)
+        self.report_seconds = report_seconds
+        self.restart_seconds = restart_seconds
+        self.stop_seconds = stop_seconds
+        self.metrics_file = File(metrics_file) if metrics_file else None
+        self.locker = Lock("supervisor")
+        self.retired = {}  # COUNTERS OF WORKERS THAT HAVE DIED
+        self.workers = [Worker(i) for i in range(workers or os.cpu_count() or 1)]
+        for worker in self.workers:
+            self._start(worker)
+        self.monitor = Thread.run("supervisor", self._monitor)
+
+    def _start(self, worker):
+        worker.process = Process(
+            f"worker {worker.num}",
+            self.params + ["--worker", worker.num],
+            # WORKERS MUST FIND THE SAME MODULES, NO MATTER HOW WE WERE STARTED
+            env={"PYTHONPATH": os.pathsep.join(p for p in sys.path if p)},
+            timeout=10 * self.report_seconds,
+            startup_timeout=60,
+            parent_thread=self,
+        )
+        worker.started = time()
+        worker.metrics = {}
+        for queue in (worker.process.stdout, worker.process.stderr):
+            # ENDS WHEN THE PROCESS CLOSES THE QUEUE
+            Thread.run(f"relay worker {worker.num}", self._relay, worker, queue, parent_thread=Null)
+        DEBUG and Log.note("Started worker {{num}} (pid={{pid}})", num=worker.num, pid=worker.process.pid)
+
+    def _relay(self, worker, queue, please_stop):
+        """
+        FORWARD WORKER OUTPUT TO OUR LOG, AND PICK OUT ITS COUNTERS
+        """
+        for line in queue:
+            if line.startswith(METRICS_PREFIX):
+                try:
+                    metrics = json_decoder(line[len(METRICS_PREFIX) :])
+                except Exception as cause:
+                    Log.warning("Bad metrics from worker {{num}}", num=worker.num, cause=cause)
+                    continue
+                with self.locker:
+                    worker.metrics = metrics
+            else:
+                Log.note("worker {{num}}: {{line}}", num=worker.num, line=line)
+
+    def _monitor(self, please_stop):
+        while not please_stop:
+            (Till(seconds=self.report_seconds) | please_stop).wait()
+            if please_stop:
+                break
+            now = time()
+            for worker in self.workers:
+                process = worker.process
+                if not process.stopped:
+                    continue
+                if worker.restart_at is None:
+                    with self.locker:
+                        _add(self.retired, worker.metrics)
+                        worker.metrics = {}
+                    lifetime = now - worker.started
+                    if lifetime < MIN_LIFETIME:
+                        worker.delay = min(MAX_RESTART_DELAY, max(self.restart_seconds, 2 * worker.delay))
+                    else:
+                        worker.delay = self.restart_seconds
+                    worker.restart_at = now + worker.delay
+                    Log.warning(
+                        "Worker {{num}} (pid={{pid}}) died after {{lifetime|round(places=2)}} seconds with"
+                        " returncode={{code}}; restart in {{delay}} seconds",
+                        num=worker.num,
+                        pid=process.pid,
+                        lifetime=lifetime,
+                        code=process.returncode,
+                        delay=worker.delay,
+                    )
+                elif worker.restart_at <= now:
+                    worker.restart_at = None
+                    worker.restarts += 1
+                    try:
+                        self._start(worker)
+                    except Exception as cause:
+                        Log.warning("Can not restart worker {{num}}", num=worker.num, cause=cause)
+                        worker.restart_at = now + worker.delay
+            if self.metrics_file:
+                self._write_metrics()
+
+    def _write_metrics(self):
+        try:
+            path = self.metrics_file.os_path
+            self.metrics_file.parent.create()
+            with open(path + ".tmp", "w") as output:
+                output.write(value2json(self.metrics()))
+            # READERS NEVER SEE A PARTIAL FILE
+            os.replace(path + ".tmp", path)
+        except Exception as cause:
+            Log.warning("Can not write {{file}}", file=self.metrics_file.abs_path, cause=cause)
+
+    def metrics(self):
+        """
+        :return: COUNTERS SUMMED OVER ALL WORKERS (INCLUDING DEAD ONES), AND THE STATE OF EACH WORKER
+        """
+        with self.locker:
+            total = {}
+            _add(total, self.retired)
+            workers = []
+            for worker in self.workers:
+                _add(total, worker.metrics)
+                workers.append({
+                    "num": worker.num,
+                    "pid": worker.metrics.get("pid"),
+                    "alive": not worker.process.stopped,
+                    "restarts": worker.restarts,
+                    "requests": worker.metrics.get("requests", 0),
+                })
+        return {"total": total, "workers": workers}
+
+    def add_child(self, child):
+        # PROCESSES AND THREADS ARE STOPPED BY US
+        pass
+
+    def remove_child(self, child):
+        pass
+
+    def stop(self):
+        self.monitor.stop().join()
+        for worker in self.workers:
+            worker.process.stdin.add("exit")
+        deadline = Till(seconds=self.stop_seconds)
+        for worker in self.workers:
+            worker.process.stopped.wait(till=deadline)
+        for worker in self.workers:
+            if not worker.process.stopped:
+                worker.process.kill()
+            worker.process.stop().join(raise_on_error=False)
+        Log.note("Supervisor stopped, totals={{total|json}}", total=self.metrics()["total"])
+
+
+class Worker(object):
+    """
+    ONE SLOT IN THE SUPERVISOR, AND THE PROCESS CURRENTLY FILLING IT
+    """
+
+    __slots__ = ["num", "process", "started", "restarts", "restart_at", "delay", "metrics"]
+
+    def __init__(self, num):
+        self.num = num
+        self.process = None
+        self.started = None
+        self.restarts = 0
+        self.restart_at = None
+        self.delay = 0
+        self.metrics = {}
+
+
+class RequestCounter(object):
+    """
+    COUNT REQUESTS BY ENDPOINT AND STATUS, FOR THE SUPERVISOR
+    """
+
+    def __init__(self):
+        self.locker = Lock("request counter")
+        self.requests = 0
+        self.endpoints = {}
+        self.statuses = {}
+
+    def after_request(self, response):
+        endpoint = flask.request.endpoint or "unknown"
+        status = f"{response.status_code // 100}xx"
+        with self.locker:
+            self.requests += 1
+            self.endpoints[endpoint] = self.endpoints.get(endpoint, 0) + 1
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+        return response
+
+    def metrics(self):
+        with self.locker:
+            return {"requests": self.requests, "endpoints": dict(self.endpoints), "status": dict(self.statuses)}
+
+
+def report_metrics(flask_app, counter, report_seconds=1):
+    """
+    RUN IN A WORKER: SEND COUNTERS TO THE SUPERVISOR ON stdout, AND STOP IF THE SUPERVISOR IS GONE
+    """
+    parent = os.getppid()
+
+    def reporter(please_stop):
+        while not please_stop:
+            metrics = {"pid": os.getpid(), **counter.metrics()}
+            if flask_app.result_cache:
+                cache = flask_app.result_cache.metrics()
+                metrics["result_cache"] = {"hits": cache["hits"], "misses": cache["misses"]}
+            if flask_app.access_log:
+                log = flask_app.access_log.metrics()
+                metrics["access_log"] = {"dropped": log["dropped"], "written": log["written"]}
+            sys.stdout.write(METRICS_PREFIX + value2json(metrics) + "\n")
+            sys.stdout.flush()
+            (Till(seconds=report_seconds) | please_stop).wait()
+            if os.getppid() != parent:
+                Log.warning("Supervisor is gone, stopping worker")
+                stop_main_thread()
+                break
+
+    return Thread.run("report metrics", reporter)
+
+
+def listen_socket(host, port, backlog=128):
+    """
+    :return: LISTENING SOCKET THAT OTHER PROCESSES CAN ALSO BIND TO (SO_REUSEPORT)
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        Log.error("SO_REUSEPORT is not supported on this platform")
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        sock.listen(backlog)
+    except Exception as cause:
+        sock.close()
+        Log.error("Can not listen on {{host}}:{{port}}", host=host, port=port, cause=cause)
+    return sock
+
+
+def _add(total, metrics):
+    """
+    ADD THE NUMBERS IN metrics INTO total (pid, AND OTHER NON-COUNTERS, ARE IGNORED)
+    """
+    for k, v in metrics.items():
+        if k == "pid":
+            continue
+        if isinstance(v, dict):
+            _add(total.setdefault(k, {}), v)
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            total[k] = total.get(k, 0) + v
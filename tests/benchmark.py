@@ -0,0 +1,284 @@
+# encoding: utf-8
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Contact: Kyle Lahnakoski (kyle@lahnakoski.com)
+#
+"""
+MEASURE THE QUERY AND INGEST HOT PATHS OF AN IN-PROCESS SpreadServer, AND InsertTable
+
+    python -m tests.benchmark --scale 1,10 --concurrency 1,4,16 --inserts 20000 --output results/benchmark.json
+
+THE OUTPUT IS JSON, SO RUNS BEFORE AND AFTER A CHANGE CAN BE COMPARED
+"""
+import os
+import platform
+import resource
+import subprocess
+from time import time
+
+from mo_files import File, TempDirectory, URL
+from mo_http import http
+from mo_json import json2value, value2json
+from mo_logs import Log, constants, startup
+from mo_sqlite import Sqlite
+from mo_threads import Lock, Thread, Till, stop_main_thread
+from mo_times.dates import Date
+
+from jx_sqlite import Container
+from spread_server.app import SpreadServerApp, ServerThread, setup_flask
+from spread_server.ingest.client import shard_lines
+
+CHINOOK = File("tests/resources/chinook.sqlite")
+SOURCE_TABLE = "invoice_items"
+TABLE = "bench.invoice_items"
+KEY = "id"
+PORT = 5106
+POLL_SECONDS = 0.005
+QUERY = (
+    "SELECT InvoiceId, sum(UnitPrice * Quantity) AS total FROM bench.invoice_items WHERE id > {i} GROUP BY InvoiceId"
+)
+
+
+def main():
+    args = startup.argparse([
+        {"name": ["--scale"], "help": "comma separated copies of the chinook fixture", "type": str, "default": "1,10"},
+        {"name": ["--concurrency"], "help": "comma separated client threads", "type": str, "default": "1,4,16"},
+        {"name": ["--requests"], "help": "requests per concurrency level", "type": int, "default": 200},
+        {"name": ["--inserts"], "help": "documents given to InsertTable", "type": int, "default": 20000},
+        {"name": ["--output"], "help": "JSON results file", "type": str, "default": "results/benchmark.json"},
+    ])
+    Log.start()
+    try:
+        results = run(
+            scales=[int(s) for s in args.scale.split(",")],
+            concurrency=[int(c) for c in args.concurrency.split(",")],
+            requests=args.requests,
+            inserts=args.inserts,
+        )
+        File(args.output).write(value2json(results, pretty=True))
+        Log.note("Benchmark written to {{file}}", file=File(args.output).abs_path)
+    finally:
+        stop_main_thread()
+
+
+def run(scales, concurrency, requests, inserts):
+    results = {
+        "started": Date.now(),
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "requests": requests,
+        "scales": [],
+        "insert": insert(inserts),
+    }
+    for scale in scales:
+        with TempDirectory() as temp:
+            constants.set({"spread_server": {"dispatch": {"DATA_DIRECTORY": (temp / "data").abs_path}}})
+            config = {
+                "flask": {"host": "127.0.0.1", "port": PORT, "threaded": True},
+                "scheduler": {"workers": max(concurrency), "max_pending": max(concurrency) * 2},
+                "cache": {"max_bytes": 2 ** 30},
+                "response_directory": (temp / "responses").abs_path,
+            }
+            app = SpreadServerApp(__name__)
+            setup_flask(app, config["flask"], config)
+            server = ServerThread(app=app, **config["flask"])
+            server.start()
+            try:
+                result = {"scale": scale, "ingest": ingest(scale, temp), "query": [], "download": []}
+                result["rows"] = result["ingest"]["rows"]
+                offset = 0
+                for c in concurrency:
+                    # EVERY QUERY IS DIFFERENT, SO THE RESULT CACHE DOES NOT ANSWER
+                    result["query"].append(query(c, requests, offset))
+                    offset += requests
+                    result["download"].append(download(c, requests))
+                result["max_rss_bytes"] = _max_rss()
+                results["scales"].append(result)
+                Log.note("scale {{scale}}: {{result|json}}", scale=scale, result=result)
+            finally:
+                server.stop()
+                app.scheduler.stop()
+    return results
+
+
+def ingest(scale, temp):
+    """
+    :return: TIME TO SEND scale COPIES OF THE FIXTURE TO /ingest
+    """
+    db = Sqlite(filename=CHINOOK)
+    try:
+        result = db.query(f"SELECT * FROM {SOURCE_TABLE}")
+    finally:
+        db.stop()
+    header = result.header
+
+    def lines():
+        for copy in range(scale):
+            for i, row in enumerate(result.data):
+                yield value2json({KEY: copy * len(result.data) + i, **dict(zip(header, row))})
+
+    start = time()
+    (shard,) = shard_lines(lines(), TABLE.split(".")[1], KEY, 1, temp / "shards", batch_size=10000)
+    shard_seconds = time() - start
+
+    start = time()
+    with open(shard.os_path, "rb") as data:
+        url = URL(f"http://127.0.0.1:{PORT}/ingest") / TABLE + {"key": KEY, "shard": 0, "shards": 1}
+        response = http.post(url, data=data)
+    seconds = time() - start
+    if response.status_code != 200:
+        Log.error("ingest failed: {{content}}", content=response.content.decode("utf8"))
+    rows = json2value(response.content.decode("utf8")).rows
+    return {
+        "rows": rows,
+        "bytes": os.path.getsize(shard.os_path),
+        "shard_seconds": shard_seconds,
+        "seconds": seconds,
+        "rows_per_second": rows / seconds,
+    }
+
+
+def insert(rows):
+    """
+    :return: TIME FOR InsertTable TO STORE rows DOCUMENTS, IN ONE CALL, IN BATCHES, AND AS JSON LINES
+    """
+    docs = [{"id": i, "a": i * 10, "s": f"text {i}", "b": {"c": i / 2}} for i in range(rows)]
+    methods = {
+        "insert": lambda facts: facts.insert(docs),
+        "insert_batches": lambda facts: [facts.insert(docs[i : i + 1000]) for i in range(0, rows, 1000)],
+        "insert_lines": lambda facts: facts.insert_lines(value2json(d) for d in docs),
+    }
+    result = {"rows": rows}
+    for name, method in methods.items():
+        facts = Container().get_or_create_facts("bench")
+        start = time()
+        method(facts)
+        seconds = time() - start
+        # A FAST INSERT THAT LOSES VALUES IS NOT A RESULT
+        stored = facts.query({"select": ["id", "a", "s", "b.c"], "sort": "id", "limit": rows, "format": "list"}).data
+        if stored != docs:
+            Log.error("{{name}} did not store the documents", name=name)
+        result[name] = {"seconds": seconds, "rows_per_second": rows / seconds}
+    Log.note("insert: {{result|json}}", result=result)
+    return result
+
+
+def query(concurrency, requests, offset):
+    """
+    :return: LATENCY FROM SUBMIT TO DONE, FOR requests QUERIES FROM concurrency CLIENTS
+    """
+    latencies = []
+
+    def one(i):
+        start = time()
+        response = http.post(f"http://127.0.0.1:{PORT}/query/sql", data=QUERY.format(i=i))
+        job = json2value(response.content.decode("utf8"))
+        if response.status_code == 202:
+            while True:
+                status = http.get_json(job.status)
+                if status.status == "done":
+                    break
+                if status.status == "failed":
+                    Log.error("query failed", cause=status.error)
+                Till(seconds=POLL_SECONDS).wait()
+        elif response.status_code != 200:
+            Log.error("query rejected: {{job|json}}", job=job)
+        return time() - start
+
+    seconds = _load(concurrency, [offset + i for i in range(requests)], one, latencies)
+    return {
+        "concurrency": concurrency,
+        "seconds": seconds,
+        "requests_per_second": requests / seconds,
+        **_summary(latencies),
+    }
+
+
+def download(concurrency, requests):
+    """
+    :return: THROUGHPUT OF /response FOR THE BIGGEST RESULT
+    """
+    response = http.post(f"http://127.0.0.1:{PORT}/query/sql", data=f"SELECT * FROM {TABLE}")
+    job = json2value(response.content.decode("utf8"))
+    while response.status_code == 202 and http.get_json(job.status).status not in ("done", "failed"):
+        Till(seconds=POLL_SECONDS).wait()
+    latencies = []
+    total = [0]
+    locker = Lock()
+
+    def one(_):
+        start = time()
+        content = http.get(job.result).content
+        with locker:
+            total[0] += len(content)
+        return time() - start
+
+    seconds = _load(concurrency, range(requests), one, latencies)
+    return {
+        "concurrency": concurrency,
+        "seconds": seconds,
+        "bytes": total[0],
+        "bytes_per_second": total[0] / seconds,
+        **_summary(latencies),
+    }
+
+
+def _load(concurrency, work, one, latencies):
+    """
+    SHARE work OVER concurrency THREADS, EACH CALLING one(w)
+    :return: ELAPSED SECONDS
+    """
+    work = list(work)
+    locker = Lock()
+
+    def client(please_stop):
+        while not please_stop:
+            with locker:
+                if not work:
+                    return
+                w = work.pop()
+            latency = one(w)
+            with locker:
+                latencies.append(latency)
+
+    start = time()
+    Thread.join_all([Thread.run(f"client {i}", client) for i in range(concurrency)])
+    return time() - start
+
+
+def _summary(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+    return {
+        "p50": _percentile(latencies, 0.50),
+        "p99": _percentile(latencies, 0.99),
+        "mean": sum(latencies) / len(latencies),
+        "max": latencies[-1],
+    }
+
+
+def _percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def _max_rss():
+    # ru_maxrss IS KILOBYTES ON LINUX, BYTES ON MACOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if platform.system() == "Darwin" else rss * 1024
+
+
+def _commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+from mo_files import TempDirectory
+from mo_http import http
+from mo_json import json2value
+from mo_testing.fuzzytestcase import FuzzyTestCase, add_error_reporting
+
+from spread_server.app import SpreadServerApp, ServerThread, setup_flask
+
+PORT = 5104
+
+
+@add_error_reporting
+class TestAccessLog(FuzzyTestCase):
+    def test_write(self):
+        with TempDirectory() as temp:
+            log_file = temp / "access.jsonl"
+            config = {
+                "flask": {"host": "127.0.0.1", "port": PORT, "threaded": True},
+                "scheduler": {"workers": 1},
+                "access_log": {"filename": log_file.abs_path, "flush_seconds": 0.1},
+            }
+            app = SpreadServerApp(__name__)
+            setup_flask(app, config["flask"], config)
+            server = ServerThread(app=app, **config["flask"])
+            server.start()
+            try:
+                http.get(f"http://127.0.0.1:{PORT}/status/nothing")
+                http.get(f"http://127.0.0.1:{PORT}/favicon.ico")
+            finally:
+                server.stop()
+                app.access_log.stop()
+                app.scheduler.stop()
+
+            records = [json2value(line) for line in log_file.read_lines() if line]
+            self.assertEqual(
+                records,
+                [
+                    {"path": "/status/nothing?", "status": 404, "endpoint": "status"},
+                    {"path": "/favicon.ico?", "endpoint": "send_favicon"},
+                ],
+            )
+            metrics = app.access_log.metrics()
+            self.assertEqual(metrics, {"dropped": 0, "written": 2, "latency": {"status": {"count": 1}}})
@@ -0,0 +1,168 @@
+import os
+
+from mo_files import File, TempDirectory
+from mo_logs import constants
+from mo_sqlite.database import Sqlite
+from mo_testing.fuzzytestcase import FuzzyTestCase, add_error_reporting
+
+from mo_sql_parsing import parse
+from mo_threads import Thread, Till
+from spread_server.dispatch import execute, required_databases, RESULT_TABLE, write_result, claim_file, is_claimed
+from spread_server.dispatch.cache import ResultCache
+from spread_server.dispatch.jobs import Scheduler, DONE
+
+
+@add_error_reporting
+class TestDispatch(FuzzyTestCase):
+    @classmethod
+    def setUpClass(cls):
+        constants.set({"spread_server": {"dispatch": {"DATA_DIRECTORY": "tests/resources"}}})
+
+    def test_required_databases(self):
+        tree = parse(
+            "SELECT e.LastName, c.n FROM chinook.employees e"
+            " JOIN (SELECT SupportRepId, count(1) AS n FROM chinook.customers GROUP BY SupportRepId) c"
+            " ON c.SupportRepId = e.EmployeeId"
+        )
+        self.assertEqual(list(required_databases(tree).keys()), ["chinook"])
+
+    def test_unknown_database(self):
+        with self.assertRaises("Unknown database"):
+            required_databases(parse("SELECT * FROM nothing.employees"))
+
+    def test_execute(self):
+        with TempDirectory() as temp:
+            output_file = temp / "result.sqlite"
+            execute("SELECT FirstName, LastName FROM chinook.employees", output_file)
+            self.assertTrue(output_file.exists)
+            self.assertFalse(File(output_file.abs_path + ".partial").exists)
+
+            db = Sqlite(filename=output_file)
+            try:
+                result = db.query(f"SELECT count(1) FROM {RESULT_TABLE}")
+                self.assertEqual(result.data, [(8,)])
+            finally:
+                db.stop()
+
+    def test_same_result_twice(self):
+        with TempDirectory() as temp:
+            output_file = temp / "result.sqlite"
+            filled = []
+            results = []
+
+            def fill(db):
+                filled.append(1)
+                Till(seconds=0.5).wait()
+                db.query(
+                    f"CREATE TABLE {RESULT_TABLE} AS"
+                    " WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i+1 FROM n WHERE i<1000)"
+                    " SELECT i FROM n"
+                )
+
+            def write(please_stop):
+                results.append(write_result(output_file, fill))
+
+            Thread.join_all([Thread.run(f"writer {i}", write) for i in range(2)])
+            # ONLY ONE WRITER RAN THE QUERY, THE OTHER REUSED ITS RESULT
+            self.assertEqual(filled, [1])
+            self.assertEqual(results, [1000, 1000])
+            self.assertFalse(is_claimed(output_file))
+            self.assertEqual(os.listdir(temp.os_path), ["result.sqlite"])
+            db = Sqlite(filename=output_file)
+            try:
+                self.assertEqual(db.query(f"SELECT count(1) FROM {RESULT_TABLE}").data, [(1000,)])
+            finally:
+                db.stop()
+
+    def test_stale_claim(self):
+        with TempDirectory() as temp:
+            output_file = temp / "result.sqlite"
+            # A pid THAT CAN NOT BE RUNNING
+            claim_file(output_file).write("999999999")
+            self.assertFalse(is_claimed(output_file))
+            rows = write_result(output_file, lambda db: db.query(f"CREATE TABLE {RESULT_TABLE} AS SELECT 1 AS a"))
+            self.assertEqual(rows, 1)
+
+    def test_scheduler(self):
+        scheduler = Scheduler(workers=2)
+        try:
+            with TempDirectory() as temp:
+                job = scheduler.submit("a", parse("SELECT * FROM chinook.genres"), temp / "a.sqlite")
+                timeout = Till(seconds=10)
+                while job.status != DONE and not timeout:
+                    Till(seconds=0.1).wait()
+                self.assertEqual(scheduler.get("a").status, DONE)
+                self.assertEqual(job.rows, 25)
+        finally:
+            scheduler.stop()
+
+    def test_scheduler_backpressure(self):
+        scheduler = Scheduler(workers=0, max_pending=1)
+        try:
+            self.assertIsNotNone(scheduler.submit("a", parse("SELECT 1"), "a.sqlite"))
+            self.assertIsNone(scheduler.submit("b", parse("SELECT 1"), "b.sqlite"))
+            self.assertGreaterEqual(scheduler.retry_after(), 1)
+        finally:
+            scheduler.stop()
+
+    def test_scheduler_same_job(self):
+        scheduler = Scheduler(workers=0)
+        try:
+            a = scheduler.submit("a", parse("SELECT 1"), "a.sqlite")
+            self.assertIs(scheduler.submit("a", parse("SELECT 1"), "a.sqlite"), a)
+        finally:
+            scheduler.stop()
+
+    def test_cache_key(self):
+        with TempDirectory() as temp:
+            cache = ResultCache(directory=temp)
+            a = cache.key("SELECT  FirstName FROM chinook.employees")
+            b = cache.key("select FirstName\nfrom chinook.employees")
+            self.assertEqual(a, b)
+            self.assertNotEqual(a, cache.key("SELECT LastName FROM chinook.employees"))
+            self.assertIsNone(cache.key("SELECT * FROM nothing.employees"))
+
+    def test_cache_key_not_cached(self):
+        with TempDirectory() as temp:
+            cache = ResultCache(directory=temp)
+            # NO DATABASE, SO NO VERSION TO KEY ON
+            self.assertIsNone(cache.key("SELECT 1"))
+            # A DIFFERENT ANSWER EVERY TIME
+            self.assertIsNone(cache.key("SELECT random() AS r FROM chinook.genres"))
+            self.assertIsNone(cache.key("SELECT * FROM chinook.invoices WHERE InvoiceDate < date('now')"))
+            self.assertIsNone(cache.key("SELECT CURRENT_TIMESTAMP AS t FROM chinook.genres"))
+            self.assertIsNotNone(cache.key("SELECT abs(GenreId) AS g FROM chinook.genres"))
+            self.assertIsNotNone(cache.key("SELECT 'current_date' AS t FROM chinook.genres"))
+
+    def test_cache_hit_date_column(self):
+        # A COLUMN NAMED date IS NOT A CALL TO date()
+        sql = (
+            "SELECT date, time FROM (SELECT InvoiceDate AS date, Total AS time FROM chinook.invoices)"
+            " WHERE date < '2009-02-01' ORDER BY date"
+        )
+        with TempDirectory() as temp:
+            cache = ResultCache(directory=temp)
+            run = cache.wrap(execute)
+            id = cache.key(sql)
+            self.assertIsNotNone(id)
+            self.assertIsNone(cache.get(id))
+            run(sql, cache.file(id))
+            self.assertEqual(cache.key(sql), id)
+            self.assertEqual(cache.get(id)[1], 6)
+            self.assertEqual(cache.metrics(), {"hits": 1, "misses": 1})
+
+    def test_cache_hit_and_evict(self):
+        with TempDirectory() as temp:
+            cache = ResultCache(directory=temp, max_bytes=1)
+            run = cache.wrap(execute)
+            a = cache.key("SELECT * FROM chinook.genres")
+            b = cache.key("SELECT * FROM chinook.employees")
+            self.assertIsNone(cache.get(a))
+            run("SELECT * FROM chinook.genres", cache.file(a))
+            self.assertEqual(cache.get(a)[1], 25)
+            run("SELECT * FROM chinook.employees", cache.file(b))
+            # ONLY THE MOST RECENT RESULT FITS
+            self.assertIsNone(cache.get(a))
+            self.assertFalse(cache.file(a).exists)
+            self.assertEqual(cache.get(b)[1], 8)
+            self.assertEqual(cache.metrics(), {"hits": 2, "misses": 2, "files": 1})
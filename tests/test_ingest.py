@@ -0,0 +1,203 @@
+import sqlite3
+
+from mo_files import File, TempDirectory, URL
+from mo_http import http
+from mo_json import json2value
+from mo_logs import constants
+from mo_sqlite.database import Sqlite
+from mo_testing.fuzzytestcase import FuzzyTestCase, add_error_reporting
+
+from spread_server import dispatch
+from spread_server.app import SpreadServerApp, ServerThread, setup_flask
+from spread_server.ingest import jump_hash, key_hash, merge, restore, shard_of, snapshot, verify
+from spread_server.ingest.client import shard_database, shard_lines
+
+CHINOOK = File("tests/resources/chinook.sqlite")
+PORT = 5109
+
+
+@add_error_reporting
+class TestIngest(FuzzyTestCase):
+    def test_jump_hash_moves_few(self):
+        keys = [key_hash(i) for i in range(10000)]
+        before = [jump_hash(k, 10) for k in keys]
+        after = [jump_hash(k, 11) for k in keys]
+        moved = [(b, a) for b, a in zip(before, after) if b != a]
+        # ONLY ROWS FOR THE NEW SHARD MOVE, ABOUT 1/11 OF THEM
+        self.assertTrue(all(a == 10 for _, a in moved))
+        self.assertAlmostEqual(len(moved) / len(keys), 1 / 11, delta=0.02)
+
+    def test_key_hash_is_stable(self):
+        self.assertEqual(shard_of(1, 7), shard_of(1.0, 7))
+        self.assertEqual(shard_of("a", 7), shard_of("a", 7))
+
+    def test_shard_database(self):
+        with TempDirectory() as temp:
+            files = shard_database(CHINOOK, "customers", "CustomerId", 3, temp)
+            total = 0
+            for i, f in enumerate(files):
+                self.assertEqual(verify(f, "customers", "CustomerId", i, 3), 0)
+                total += _count(f, "customers")
+            self.assertEqual(total, _count(CHINOOK, "customers"))
+
+    def test_shard_lines(self):
+        lines = ['{"id": %d, "name": "n%d", "tags": ["x"]}' % (i, i) for i in range(100)]
+        with TempDirectory() as temp:
+            files = shard_lines(lines, "docs", "id", 4, temp, batch_size=10)
+            self.assertEqual(sum(_count(f, "docs") for f in files), 100)
+            for i, f in enumerate(files):
+                self.assertEqual(verify(f, "docs", "id", i, 4), 0)
+
+    def test_snapshot_restore(self):
+        with TempDirectory() as temp:
+            previous = dispatch.DATA_DIRECTORY
+            _data_directory("tests/resources")
+            try:
+                snapshot("chinook", temp / "chinook.snapshot")
+                _data_directory((temp / "data").abs_path)
+                restore(temp / "chinook.snapshot", "copy")
+                self.assertEqual(_count(temp / "data" / "copy.sqlite", "customers"), _count(CHINOOK, "customers"))
+            finally:
+                _data_directory(previous)
+
+    def test_merge(self):
+        with TempDirectory() as temp:
+            files = shard_database(CHINOOK, "customers", "CustomerId", 2, temp / "shards")
+            previous = dispatch.DATA_DIRECTORY
+            _data_directory((temp / "data").abs_path)
+            try:
+                added = sum(merge(f, "copy.customers") for f in files)
+                self.assertEqual(added, _count(CHINOOK, "customers"))
+                local = temp / "data" / "copy.sqlite"
+                self.assertEqual(_count(local, "customers"), _count(CHINOOK, "customers"))
+                # SAME NAMES, TYPES AND PRIMARY KEY AS THE SOURCE
+                self.assertEqual(_columns(local, "customers"), _columns(CHINOOK, "customers"))
+                with self.assertRaises("UNIQUE constraint failed"):
+                    merge(files[0], "copy.customers")
+            finally:
+                _data_directory(previous)
+
+    def test_merge_rejects_bad_name(self):
+        with TempDirectory() as temp:
+            (file,) = shard_database(CHINOOK, "customers", "CustomerId", 1, temp)
+            with self.assertRaises("Not allowed to use database"):
+                merge(file, "main.customers")
+
+    def test_ingest_endpoint(self):
+        with TempDirectory() as temp:
+            files = shard_database(CHINOOK, "customers", "CustomerId", 2, temp / "shards")
+            previous = dispatch.DATA_DIRECTORY
+            _data_directory((temp / "data").abs_path)
+            config = {
+                "flask": {"host": "127.0.0.1", "port": PORT, "threaded": True},
+                "scheduler": {"workers": 1},
+                "response_directory": (temp / "responses").abs_path,
+                "ingest": {"shard": 1, "shards": 2},
+            }
+            app = SpreadServerApp(__name__)
+            setup_flask(app, config["flask"], config)
+            server = ServerThread(app=app, **config["flask"])
+            server.start()
+            try:
+                url = URL(f"http://127.0.0.1:{PORT}/ingest/copy.customers")
+
+                def post(file, shard, shards=2):
+                    with open(file.os_path, "rb") as data:
+                        return http.post(url + {"key": "CustomerId", "shard": shard, "shards": shards}, data=data)
+
+                # NOT THIS NODE'S SHARD
+                response = post(files[0], 0)
+                self.assertEqual(response.status_code, 400)
+                response = post(files[1], 1, shards=3)
+                self.assertEqual(response.status_code, 400)
+                # ROWS OF SHARD 0, CLAIMING TO BE SHARD 1
+                response = post(files[0], 1)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(
+                    json2value(response.content.decode("utf8")).misplaced, _count(files[0], "customers")
+                )
+                self.assertFalse((temp / "data" / "copy.sqlite").exists)
+
+                response = post(files[1], 1)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(
+                    json2value(response.content.decode("utf8")),
+                    {"table": "copy.customers", "rows": _count(files[1], "customers")},
+                )
+                self.assertEqual(_count(temp / "data" / "copy.sqlite", "customers"), _count(files[1], "customers"))
+            finally:
+                server.stop()
+                app.scheduler.stop()
+                _data_directory(previous)
+
+    def test_restore_over_existing(self):
+        with TempDirectory() as temp:
+            previous = dispatch.DATA_DIRECTORY
+            _data_directory("tests/resources")
+            try:
+                snapshot("chinook", temp / "chinook.snapshot")
+                _data_directory((temp / "data").abs_path)
+                local = temp / "data" / "copy.sqlite"
+                local.parent.create()
+                old = sqlite3.connect(local.os_path, isolation_level=None)
+                try:
+                    # LEAVE THE OLD FILE'S CHANGES IN ITS -wal
+                    old.execute("PRAGMA journal_mode=WAL")
+                    old.execute("PRAGMA wal_autocheckpoint=0")
+                    old.execute("CREATE TABLE old (a INTEGER)")
+                    old.execute("INSERT INTO old VALUES (1)")
+                    self.assertTrue(File(local.abs_path + "-wal").exists)
+                    restore(temp / "chinook.snapshot", "copy")
+                    self.assertEqual(_count(local, "customers"), _count(CHINOOK, "customers"))
+                    with self.assertRaises("no such table"):
+                        _count(local, "old")
+                finally:
+                    old.close()
+            finally:
+                _data_directory(previous)
+
+    def test_read_sql(self):
+        db = Sqlite()
+        try:
+            db.read_sql("tests/resources/chinook.sql")
+            self.assertEqual(db.query("SELECT count(1) FROM customers").data, [(59,)])
+        finally:
+            db.stop()
+
+    def test_read_sql_all_or_nothing(self):
+        with TempDirectory() as temp:
+            script = temp / "bad.sql"
+            script.write(
+                "BEGIN TRANSACTION;\n"
+                "CREATE TABLE t (a INTEGER);\n"
+                "INSERT INTO t VALUES (1); INSERT INTO t VALUES ('a;b');\n"
+                "INSERT INTO missing VALUES (3);\n"
+                "COMMIT;\n"
+            )
+            db = Sqlite()
+            try:
+                with self.assertRaises("no such table"):
+                    db.read_sql(script)
+                self.assertEqual(db.query("SELECT count(1) FROM sqlite_master WHERE name='t'").data, [(0,)])
+            finally:
+                db.stop()
+
+
+def _data_directory(directory):
+    constants.set({"spread_server": {"dispatch": {"DATA_DIRECTORY": directory}}})
+
+
+def _columns(file, table):
+    db = Sqlite(filename=file)
+    try:
+        return [(name, type_, pk) for _, name, type_, _, _, pk in db.query(f"PRAGMA table_info({table})").data]
+    finally:
+        db.stop()
+
+
+def _count(file, table):
+    db = Sqlite(filename=file)
+    try:
+        return db.query(f"SELECT count(1) FROM {table}").data[0][0]
+    finally:
+        db.stop()
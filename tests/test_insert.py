@@ -0,0 +1,128 @@
+from mo_json import value2json
+from mo_logs import constants
+from mo_sqlite import Sqlite
+from mo_sqlite.transacfion import Transaction
+from mo_sqlite.utils import value_to_param
+from mo_testing.fuzzytestcase import FuzzyTestCase, add_error_reporting
+from mo_times import Date, Duration
+
+from jx_sqlite import Container
+from jx_sqlite import insert_table
+from jx_sqlite.insert_table import _leaves
+
+MIXED = [
+    {"id": 0, "a": 1, "b": {"c": "x"}},
+    {"id": 1, "a": [2, 3], "t": []},
+    {"id": 2, "b": {"c": "y", "d": [{"e": 1}, {"e": 2}]}},
+    {"id": 3, "a": 4, "b": {"d": {"e": 3}}},
+    {"id": 4, "f": 1.5, "t": [], "g": None},
+]
+MIXED_QUERY = {"select": ["id", "a", "b.c", "b.d.e", "f"], "sort": "id", "format": "list"}
+
+
+@add_error_reporting
+class TestInsert(FuzzyTestCase):
+    def test_value_to_param(self):
+        self.assertEqual(value_to_param(Date("2020-01-02")), Date("2020-01-02").unix)
+        self.assertEqual(value_to_param(Duration("day")), 86400)
+        self.assertIsNone(value_to_param(None))
+        self.assertEqual(value_to_param({"a": 1}), ".")
+        self.assertEqual(value_to_param([1, 2]), ".")
+        self.assertEqual(value_to_param("text"), "text")
+        self.assertEqual(value_to_param(3.5), 3.5)
+
+    def test_execute_many_round_trip(self):
+        rows = [
+            (1, "a'b", Date("2020-01-02"), Duration("hour"), None),
+            (2, "", Date("1970-01-01"), Duration("second"), 2.5),
+            (3, None, None, None, {"nested": True}),
+        ]
+        db = Sqlite()
+        try:
+            with db.transaction() as t:
+                t.execute("CREATE TABLE t (id INTEGER, s TEXT, d REAL, n REAL, x)")
+                t.execute_many(
+                    "INSERT INTO t (id, s, d, n, x) VALUES (?, ?, ?, ?, ?)",
+                    [tuple(value_to_param(v) for v in row) for row in rows],
+                )
+            self.assertEqual(
+                db.query("SELECT id, s, d, n, x FROM t ORDER BY id").data,
+                [
+                    (1, "a'b", Date("2020-01-02").unix, 3600, None),
+                    (2, "", 0, 1, 2.5),
+                    (3, None, None, None, "."),
+                ],
+            )
+        finally:
+            db.stop()
+
+    def test_batches(self):
+        calls = []
+        execute_many = Transaction.execute_many
+
+        def spy(self, command, params):
+            calls.append(len(params))
+            return execute_many(self, command, params)
+
+        previous = insert_table.INSERT_BATCH_SIZE
+        constants.set({"jx_sqlite": {"insert_table": {"INSERT_BATCH_SIZE": 3}}})
+        Transaction.execute_many = spy
+        try:
+            facts = Container().get_or_create_facts("docs")
+            facts.insert([{"a": i, "b": {"c": str(i)}} for i in range(10)])
+        finally:
+            Transaction.execute_many = execute_many
+            constants.set({"jx_sqlite": {"insert_table": {"INSERT_BATCH_SIZE": previous}}})
+        self.assertEqual(calls, [3, 3, 3, 1])
+        result = facts.query({"select": ["a", "b.c"], "sort": "a", "format": "list"})
+        self.assertEqual(result.data, [{"a": i, "b": {"c": str(i)}} for i in range(10)])
+
+    def test_leaves(self):
+        self.assertEqual(
+            list(_leaves({"a": [], "b": {"c": None, "d": 1}, "e": [1], "f": {}})), [("b.d", 1), ("e", [1])]
+        )
+
+    def test_insert_lines_same_as_insert(self):
+        expected = Container().get_or_create_facts("docs")
+        expected.insert(MIXED)
+        expected = expected.query(MIXED_QUERY).data
+        # EVERY PAIR OF DOCUMENTS THAT DISAGREE ON A TYPE IS IN ONE BATCH
+        for batch_size in (None, 2):
+            facts = Container().get_or_create_facts("docs")
+            count = facts.insert_lines((value2json(d) for d in MIXED), batch_size=batch_size)
+            self.assertEqual(count, len(MIXED))
+            self.assertEqual(facts.query(MIXED_QUERY).data, expected)
+
+    def test_many_batches_keep_values(self):
+        docs = [{"id": i, "a": i * 10, "b": {"c": str(i)}} for i in range(7)]
+        facts = Container().get_or_create_facts("docs")
+        count = facts.insert_lines((value2json(d) for d in docs), batch_size=2)
+        self.assertEqual(count, 7)
+        facts.insert([{"id": 7, "a": 70, "b": {"c": "7"}}])
+        docs.append({"id": 7, "a": 70, "b": {"c": "7"}})
+        result = facts.query({"select": ["id", "a", "b.c"], "sort": "id", "format": "list"})
+        self.assertEqual(result.data, docs)
+
+    def test_scalar_after_nested(self):
+        facts = Container().get_or_create_facts("docs")
+        facts.insert([{"id": 0, "a": [1, 2]}])
+        facts.insert([{"id": 1, "a": 3}])
+        result = facts.query({"select": ["id", "a"], "sort": "id", "format": "list"})
+        self.assertEqual(result.data, [{"id": 0, "a": [{"a": 1}, {"a": 2}]}, {"id": 1, "a": {"a": 3}}])
+
+    def test_object_where_array(self):
+        for docs in (
+            [{"id": 0, "d": [{"e": 1}, {"e": 2}]}, {"id": 1, "d": {"e": 3}}],
+            [{"id": 1, "d": {"e": 3}}, {"id": 0, "d": [{"e": 1}, {"e": 2}]}],
+        ):
+            facts = Container().get_or_create_facts("docs")
+            facts.insert(docs)
+            result = facts.query({"from": "docs.d", "select": ["e"], "sort": "e", "format": "list"})
+            self.assertEqual(result.data, [{"e": 1}, {"e": 2}, {"e": 3}])
+
+    def test_later_array_wins(self):
+        facts = Container().get_or_create_facts("docs")
+        facts.insert_lines([value2json({"id": 0, "a": 1}), value2json({"id": 1, "a": [2, 3]})])
+        result = facts.query({"select": ["id", "a"], "sort": "id", "format": "list"})
+        # NESTED VALUES COME BACK AS ONE OBJECT PER ELEMENT
+        self.assertEqual(result.data, [{"id": 0, "a": {"a": 1}}, {"id": 1, "a": [{"a": 2}, {"a": 3}]}])
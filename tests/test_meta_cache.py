@@ -0,0 +1,58 @@
+from mo_testing.fuzzytestcase import FuzzyTestCase, add_error_reporting
+from mo_threads import Thread, Till
+
+from pyLibrary.meta import cache
+
+
+@add_error_reporting
+class TestMetaCache(FuzzyTestCase):
+    def test_single_flight(self):
+        calls = []
+
+        @cache(duration=60)
+        def slow(x):
+            calls.append(x)
+            Till(seconds=0.2).wait()
+            return x * 2
+
+        Thread.join_all([Thread.run(f"call {i}", lambda please_stop: slow(1)) for i in range(10)])
+        self.assertEqual(calls, [1])
+        self.assertEqual(slow.stats(), {"hits": 9, "misses": 1, "entries": 1})
+
+    def test_bounded(self):
+        @cache(duration=60, max_entries=3)
+        def double(x):
+            return x * 2
+
+        for i in range(10):
+            self.assertEqual(double(i), i * 2)
+        stats = double.stats()
+        self.assertEqual(stats["entries"], 3)
+        self.assertEqual(stats["evictions"], 7)
+
+    def test_expiry(self):
+        calls = []
+
+        @cache(duration=0.1)
+        def f(x):
+            calls.append(x)
+            return x
+
+        f(1)
+        Till(seconds=0.2).wait()
+        f(1)
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual(f.stats()["expirations"], 1)
+
+    def test_method(self):
+        class Thing(object):
+            @cache
+            def get(self, x):
+                return x
+
+        a, b = Thing(), Thing()
+        a.get(1)
+        a.get(1)
+        b.get(1)
+        self.assertEqual(Thing.get.stats(a), {"hits": 1, "misses": 1})
+        self.assertEqual(Thing.get.stats(b), {"hits": 0, "misses": 1})
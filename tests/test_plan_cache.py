@@ -0,0 +1,67 @@
+from mo_testing.fuzzytestcase import FuzzyTestCase, add_error_reporting
+
+from jx_sqlite import Container
+from jx_sqlite.plan_cache import PlanCache
+
+
+@add_error_reporting
+class TestPlanCache(FuzzyTestCase):
+    def test_key_ignores_order(self):
+        a = PlanCache.key({"from": "t", "select": "a", "where": {"eq": {"a": 1}}})
+        b = PlanCache.key({"where": {"eq": {"a": 1}}, "select": "a", "from": "t"})
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, PlanCache.key({"from": "t", "select": "a", "where": {"eq": {"a": 2}}}))
+
+    def test_relative_time_not_cached(self):
+        self.assertIsNone(PlanCache.key({"from": "t", "where": {"gt": {"time": {"date": "today-week"}}}}))
+
+    def test_schema_change_clears(self):
+        plans = PlanCache()
+        version = plans.version("t")
+        plans.add("t", "q", "plan", version)
+        self.assertEqual(plans.get("t", "q"), "plan")
+        plans.clear("t")
+        self.assertIsNone(plans.get("t", "q"))
+
+    def test_stale_plan_not_kept(self):
+        plans = PlanCache()
+        version = plans.version("t")
+        plans.clear("t")  # SCHEMA CHANGED WHILE PLANNING
+        plans.add("t", "q", "plan", version)
+        self.assertIsNone(plans.get("t", "q"))
+        self.assertEqual(plans.stats(), {"hits": 0, "misses": 1, "plans": 0})
+
+    def test_query_hit_then_miss(self):
+        container = Container()
+        facts = container.get_or_create_facts("docs")
+        facts.insert([{"a": 1}, {"a": 2}])
+        plans = container.namespace.plans
+        query = {"select": ["a"], "sort": "a", "format": "list"}
+
+        self.assertEqual(facts.query({**query}).data, [{"a": 1}, {"a": 2}])
+        first = plans.stats()
+        self.assertEqual(facts.query({**query}).data, [{"a": 1}, {"a": 2}])
+        second = plans.stats()
+        self.assertEqual(second["hits"], first["hits"] + 1)
+
+        # NEW COLUMN, NEW SCHEMA VERSION, SO THE PLAN IS MADE AGAIN
+        facts.insert([{"a": 3, "b": "x"}])
+        self.assertEqual(facts.query({**query}).data, [{"a": 1}, {"a": 2}, {"a": 3}])
+        third = plans.stats()
+        self.assertEqual(third["hits"], second["hits"])
+        self.assertEqual(third["misses"], second["misses"] + 1)
+
+    def test_nested_property_shares_fact_name(self):
+        facts = Container().get_or_create_facts("docs")
+        facts.insert([{"id": 1, "docs": {"items": [{"x": 1}, {"x": 2}]}}])
+        snowflake = facts.snowflake
+        self.assertEqual(snowflake.get_table("docs").nested_path, ["docs"])
+        self.assertEqual(snowflake.get_table("docs.docs.items").nested_path, ["docs.docs.items.$A", "docs"])
+        # Schema.get_table() IS RELATIVE TO ITS TABLE
+        self.assertEqual(
+            snowflake.get_schema(["docs"]).get_table("docs.items").nested_path, ["docs.docs.items.$A", "docs"]
+        )
+        with self.assertRaises("Expecting path starting with"):
+            snowflake.get_table("items")
+        result = facts.query({"from": "docs.docs.items", "select": ["x"], "sort": "x", "format": "list"})
+        self.assertEqual(result.data, [{"x": 1}, {"x": 2}])
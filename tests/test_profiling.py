@@ -0,0 +1,42 @@
+from mo_http import http
+from mo_logs import constants
+from mo_testing.fuzzytestcase import FuzzyTestCase, add_error_reporting
+
+from spread_server.app import SpreadServerApp, ServerThread, setup_flask
+
+PORT = 5107
+server = None
+app = None
+
+
+@add_error_reporting
+class TestProfiling(FuzzyTestCase):
+    @classmethod
+    def setUpClass(cls):
+        global server, app
+        config = {"flask": {"host": "127.0.0.1", "port": PORT, "threaded": True}, "scheduler": {"workers": 1}}
+        app = SpreadServerApp(__name__)
+        setup_flask(app, config["flask"], config)
+        server = ServerThread(app=app, **config["flask"])
+        server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        server.stop()
+        app.scheduler.stop()
+
+    def test_off_by_default(self):
+        response = http.get(f"http://127.0.0.1:{PORT}/status?profile=1")
+        self.assertNotIn("X-Profiled-Status", response.headers)
+
+    def test_profile(self):
+        constants.set({"spread_server": {"profiling": {"PROFILE": True}}})
+        try:
+            by_param = http.get(f"http://127.0.0.1:{PORT}/status?profile=1")
+            by_header = http.get(f"http://127.0.0.1:{PORT}/status", headers={"X-Profile": "1"})
+        finally:
+            constants.set({"spread_server": {"profiling": {"PROFILE": False}}})
+        for response in (by_param, by_header):
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["X-Profiled-Status"], "200 OK")
+            self.assertIn("num_calls", response.content.decode("utf8"))
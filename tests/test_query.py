@@ -3,6 +3,8 @@ from mo_testing.fuzzytestcase import FuzzyTestCase, add_error_reporting
 
 from mo_files import URL, File
 from mo_http import http
+from mo_json import json2value
+from mo_threads import Till
 
 TEST_DATABASE = "tests/resources/chinook.sql"
 host = URL("http://localhost:5000")
@@ -20,5 +22,47 @@ class TestBasic(FuzzyTestCase):
 
     def test_simple_query(self):
         response = http.post(host / "query/sql", data="SELECT * FROM chinook.employees")
-        self.assertEqual(response.status_code, 201)
-        self.assertTrue(response.headers["Location"].endswith(".sqlite"))
+        # 200 WHEN THE RESULT IS ALREADY CACHED
+        self.assertIn(response.status_code, (200, 202))
+        job = json2value(response.content.decode("utf8"))
+        if response.status_code == 200:
+            self.assertEqual(response.headers["Location"], job.result)
+        else:
+            self.assertEqual(response.headers["Location"], job.status)
+
+    def test_cached(self):
+        first = http.post(host / "query/sql", data="SELECT * FROM chinook.customers")
+        job = json2value(first.content.decode("utf8"))
+        timeout = Till(seconds=10)
+        while not timeout:
+            if http.get_json(job.status).status in ("done", "failed"):
+                break
+            Till(seconds=0.1).wait()
+        second = http.post(host / "query/sql", data="select *\nfrom chinook.customers")
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(json2value(second.content.decode("utf8")), {"id": job.id, "rows": 59})
+
+    def test_status(self):
+        response = http.post(host / "query/sql", data="SELECT * FROM chinook.employees")
+        job = json2value(response.content.decode("utf8"))
+        timeout = Till(seconds=10)
+        while not timeout:
+            status = http.get_json(job.status)
+            if status.status in ("done", "failed"):
+                break
+            Till(seconds=0.1).wait()
+        self.assertEqual(status, {"id": job.id, "status": "done", "rows": 8})
+
+    def test_metrics(self):
+        before = http.get_json(host / "status").result_cache
+        for _ in range(2):
+            response = http.post(host / "query/sql", data="SELECT * FROM chinook.genres")
+            job = json2value(response.content.decode("utf8"))
+            timeout = Till(seconds=10)
+            while not timeout:
+                if http.get_json(job.status).status in ("done", "failed"):
+                    break
+                Till(seconds=0.1).wait()
+        after = http.get_json(host / "status").result_cache
+        # THE SECOND REQUEST IS ANSWERED FROM THE CACHE
+        self.assertGreater(after.hits, before.hits)
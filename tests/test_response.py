@@ -0,0 +1,70 @@
+from mo_http import http
+from mo_logs import constants
+from mo_math import randoms
+from mo_testing.fuzzytestcase import FuzzyTestCase, add_error_reporting
+
+from spread_server.actions.query import RESPONSE_DIRECTORY
+from spread_server.app import SpreadServerApp, ServerThread, setup_flask
+
+PORT = 5103
+CONTENT = bytes(range(256)) * 1000
+server = None
+
+
+@add_error_reporting
+class TestResponse(FuzzyTestCase):
+    @classmethod
+    def setUpClass(cls):
+        global server
+        config = {"flask": {"host": "127.0.0.1", "port": PORT, "threaded": True}, "scheduler": {"workers": 1}}
+        app = SpreadServerApp(__name__)
+        setup_flask(app, config["flask"], config)
+        server = ServerThread(app=app, **config["flask"])
+        server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        server.stop()
+
+    def setUp(self):
+        self.name = f"{randoms.filename()}.sqlite"
+        self.file = RESPONSE_DIRECTORY / self.name
+        self.file.write_bytes(CONTENT)
+        self.url = f"http://127.0.0.1:{PORT}/response/{self.name}"
+
+    def tearDown(self):
+        self.file.delete()
+
+    def test_full(self):
+        response = http.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, CONTENT)
+
+    def test_range(self):
+        response = http.get(self.url, headers={"Range": "bytes=1000-1009"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers["Content-Range"], f"bytes 1000-1009/{len(CONTENT)}")
+        self.assertEqual(response.content, CONTENT[1000:1010])
+
+    def test_unchanged(self):
+        etag = http.get(self.url).headers["ETag"]
+        response = http.get(self.url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_stale_if_range(self):
+        response = http.get(self.url, headers={"Range": "bytes=0-9", "If-Range": '"old"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, CONTENT)
+
+    def test_gzip(self):
+        constants.set({"spread_server": {"actions": {"response": {"COMPRESS": True}}}})
+        try:
+            response = http.get(self.url, headers={"Accept-Encoding": "gzip"})
+        finally:
+            constants.set({"spread_server": {"actions": {"response": {"COMPRESS": False}}}})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(response.content, CONTENT)
+
+    def test_missing(self):
+        response = http.get(f"http://127.0.0.1:{PORT}/response/missing.sqlite")
+        self.assertEqual(response.status_code, 404)
@@ -0,0 +1,142 @@
+from mo_files import TempDirectory
+from mo_http import http
+from mo_logs import constants
+from mo_sqlite.database import Sqlite
+from mo_testing.fuzzytestcase import FuzzyTestCase, add_error_reporting
+
+from mo_sql_parsing import parse
+from spread_server import dispatch
+from spread_server.app import SpreadServerApp, ServerThread, setup_flask
+from spread_server.dispatch import RESULT_TABLE
+from spread_server.dispatch.scatter import Coordinator, split_query
+
+PORTS = [5101, 5102]
+COORDINATOR_PORT = 5108
+servers = []
+state = {}
+
+
+@add_error_reporting
+class TestScatter(FuzzyTestCase):
+    @classmethod
+    def setUpClass(cls):
+        # EVERY NODE HAS THE SAME chinook SHARD, SO TOTALS ARE DOUBLED
+        state["data_directory"] = dispatch.DATA_DIRECTORY
+        constants.set({"spread_server": {"dispatch": {"DATA_DIRECTORY": "tests/resources"}}})
+        # NODES IN ONE PROCESS MUST NOT WRITE THE SAME RESULT FILES
+        state["temp"] = TempDirectory().__enter__()
+        for port in PORTS:
+            config = {
+                "flask": {"host": "127.0.0.1", "port": port, "threaded": True},
+                "scheduler": {"workers": 2},
+                "response_directory": (state["temp"] / str(port)).abs_path,
+            }
+            app = SpreadServerApp(__name__)
+            setup_flask(app, config["flask"], config)
+            server = ServerThread(app=app, **config["flask"])
+            server.start()
+            servers.append((server, app))
+
+    @classmethod
+    def tearDownClass(cls):
+        for server, app in servers:
+            server.stop()
+            app.scheduler.stop()
+        del servers[:]
+        state.pop("temp").__exit__(None, None, None)
+        constants.set({"spread_server": {"dispatch": {"DATA_DIRECTORY": state.pop("data_directory")}}})
+
+    def test_split_avg(self):
+        map_query, reduce_query = split_query(parse(
+            "SELECT BillingCountry, avg(Total) AS a FROM chinook.invoices GROUP BY BillingCountry"
+        ))
+        self.assertEqual(
+            map_query,
+            {
+                "select": [
+                    {"value": "BillingCountry", "name": "_g0"},
+                    {"value": {"sum": "Total"}, "name": "_p0"},
+                    {"value": {"count": "Total"}, "name": "_p1"},
+                ],
+                "from": "chinook.invoices",
+                "groupby": [{"value": "BillingCountry"}],
+            },
+        )
+        self.assertEqual(
+            reduce_query["select"],
+            [
+                {"value": "_g0", "name": "BillingCountry"},
+                {"value": {"div": [{"total": "_p0"}, {"sum": "_p1"}]}, "name": "a"},
+            ],
+        )
+
+    def test_ungrouped_column(self):
+        with self.assertRaises("neither grouped nor aggregated"):
+            split_query(parse("SELECT Country, City, count(1) AS n FROM chinook.customers GROUP BY Country"))
+
+    def test_coordinator_rejects(self):
+        config = {
+            "flask": {"host": "127.0.0.1", "port": COORDINATOR_PORT, "threaded": True},
+            "scheduler": {"workers": 1},
+            "coordinator": {"nodes": [f"http://127.0.0.1:{p}" for p in PORTS]},
+            "response_directory": (state["temp"] / "coordinator").abs_path,
+        }
+        app = SpreadServerApp(__name__)
+        setup_flask(app, config["flask"], config)
+        server = ServerThread(app=app, **config["flask"])
+        server.start()
+        try:
+            response = http.post(
+                f"http://127.0.0.1:{COORDINATOR_PORT}/query/sql",
+                data="SELECT Country, City, count(1) AS n FROM chinook.customers GROUP BY Country",
+            )
+        finally:
+            server.stop()
+            app.scheduler.stop()
+        self.assertEqual(response.status_code, 400)
+
+    def test_order_by_aggregate_alias(self):
+        _, reduce_query = split_query(parse(
+            "SELECT Country, count(1) AS n FROM chinook.customers GROUP BY Country ORDER BY n DESC"
+        ))
+        self.assertEqual(reduce_query["orderby"], [{"value": "n", "sort": "desc"}])
+
+    def test_count(self):
+        data = self._run("SELECT count(1) AS n, max(EmployeeId) AS m FROM chinook.employees")
+        self.assertEqual(data, [(16, 8)])
+
+    def test_group_by(self):
+        data = self._run(
+            "SELECT Country, count(1) AS n FROM chinook.customers"
+            " WHERE Country IN ('Canada', 'France') GROUP BY Country ORDER BY Country"
+        )
+        self.assertEqual(data, [("Canada", 16), ("France", 10)])
+
+    def test_order_limit(self):
+        data = self._run("SELECT LastName FROM chinook.employees ORDER BY LastName LIMIT 3")
+        self.assertEqual(data, [("Adams",), ("Adams",), ("Callahan",)])
+
+    def test_order_by_unselected(self):
+        map_query, reduce_query = split_query(parse(
+            "SELECT FirstName FROM chinook.employees ORDER BY LastName LIMIT 3"
+        ))
+        self.assertEqual(map_query["select"][1], {"value": "LastName", "name": "_o1"})
+        self.assertEqual(reduce_query["select"], [{"value": "FirstName"}])
+        self.assertEqual(reduce_query["orderby"], [{"value": "_o1"}])
+        data = self._run("SELECT FirstName FROM chinook.employees ORDER BY LastName LIMIT 3")
+        self.assertEqual(data, [("Andrew",), ("Andrew",), ("Laura",)])
+
+    def test_order_by_unselected_distinct(self):
+        with self.assertRaises("Can not distribute SELECT DISTINCT with ORDER BY"):
+            split_query(parse("SELECT DISTINCT FirstName FROM chinook.employees ORDER BY LastName"))
+
+    def _run(self, sql):
+        coordinator = Coordinator(nodes=[f"http://127.0.0.1:{p}" for p in PORTS])
+        with TempDirectory() as temp:
+            output_file = temp / "result.sqlite"
+            coordinator.execute(sql, output_file)
+            db = Sqlite(filename=output_file)
+            try:
+                return db.query(f"SELECT * FROM {RESULT_TABLE}").data
+            finally:
+                db.stop()
@@ -0,0 +1,70 @@
+from time import sleep
+
+from mo_files import TempDirectory
+from mo_sqlite import Sqlite
+from mo_testing.fuzzytestcase import FuzzyTestCase, add_error_reporting
+from mo_threads import Thread, Till
+
+
+@add_error_reporting
+class TestSqlite(FuzzyTestCase):
+    def test_concurrent_reads(self):
+        with TempDirectory() as temp:
+            db = Sqlite(filename=(temp / "db.sqlite").abs_path, readers=4)
+            try:
+                db.query("CREATE TABLE t (a INTEGER)")
+                with db.transaction() as t:
+                    for i in range(1, 101):
+                        t.execute(f"INSERT INTO t VALUES ({i})")
+                results = []
+
+                def read(please_stop):
+                    for _ in range(10):
+                        results.append(db.query("SELECT count(1), sum(a) FROM t").data)
+
+                Thread.join_all([Thread.run(f"read {i}", read) for i in range(8)])
+                self.assertEqual(results, [[(100, 5050)]] * 80)
+                metrics = db.metrics()
+                self.assertEqual(metrics["queries"], 80)
+                self.assertEqual(sum(metrics["queries_per_reader"]), 80)
+            finally:
+                db.stop()
+
+    def test_read_own_write(self):
+        with TempDirectory() as temp:
+            db = Sqlite(filename=(temp / "db.sqlite").abs_path, readers=2, trace=False)
+            try:
+                db.query("CREATE TABLE t (a INTEGER)")
+                for i in range(20):
+                    db.query(f"INSERT INTO t VALUES ({i})")
+                    self.assertEqual(db.query("SELECT count(1) FROM t").data, [(i + 1,)])
+                with db.transaction() as t:
+                    t.execute("INSERT INTO t VALUES (100)")
+                    # NOT YET COMMITTED, SO ONLY THIS THREAD'S TRANSACTION CAN SEE IT
+                    self.assertEqual(db.query("SELECT count(1) FROM t WHERE a=100").data, [(1,)])
+                self.assertEqual(db.query("SELECT count(1) FROM t").data, [(21,)])
+            finally:
+                db.stop()
+
+    def test_stop_fails_queued_reads(self):
+        with TempDirectory() as temp:
+            db = Sqlite(filename=(temp / "db.sqlite").abs_path, readers=1)
+            db.create_function("slow", 0, lambda: sleep(0.5) or 1)
+            results = []
+
+            def read(command, please_stop):
+                try:
+                    results.append(db.query(command).data)
+                except Exception as cause:
+                    results.append(cause)
+
+            busy = Thread.run("busy", read, "SELECT slow()")
+            Till(seconds=0.1).wait()
+            waiting = [Thread.run(f"waiting {i}", read, "SELECT 1") for i in range(3)]
+            Till(seconds=0.1).wait()
+            db.stop()
+            Thread.join_all([busy] + waiting)
+            self.assertEqual(results[0], [(1,)])
+            self.assertEqual(len(results), 4)
+            for r in results[1:]:
+                self.assertIn("database is closed", str(r))
@@ -0,0 +1,117 @@
+import sys
+
+from mo_files import TempDirectory
+from mo_http import http
+from mo_json import value2json
+from mo_testing.fuzzytestcase import FuzzyTestCase, add_error_reporting
+from mo_threads import Till
+
+from spread_server.app import SpreadServerApp, ServerThread, setup_flask
+from spread_server.supervisor import RequestCounter, Supervisor, _add
+
+PORT = 5105
+SUPERVISOR_PORT = 5110
+
+
+@add_error_reporting
+class TestSupervisor(FuzzyTestCase):
+    def test_shared_port(self):
+        config = {"flask": {"host": "127.0.0.1", "port": PORT, "threaded": True}, "scheduler": {"workers": 1}}
+        servers, apps, counters = [], [], []
+        try:
+            for _ in range(2):
+                app = SpreadServerApp(__name__)
+                setup_flask(app, config["flask"], config)
+                counter = RequestCounter()
+                app.after_request(counter.after_request)
+                server = ServerThread(app=app, reuse_port=True, **config["flask"])
+                server.start()
+                servers.append(server)
+                apps.append(app)
+                counters.append(counter)
+
+            for _ in range(20):
+                response = http.get(f"http://127.0.0.1:{PORT}/status")
+                self.assertEqual(response.status_code, 200)
+        finally:
+            for server, app in zip(servers, apps):
+                server.stop()
+                app.scheduler.stop()
+
+        total = {}
+        for counter in counters:
+            _add(total, {"pid": 1, **counter.metrics()})
+        self.assertEqual(total, {"requests": 20, "status": {"2xx": 20}})
+
+    def test_counter(self):
+        config = {"flask": {"host": "127.0.0.1", "port": PORT, "threaded": True}, "scheduler": {"workers": 1}}
+        app = SpreadServerApp(__name__)
+        setup_flask(app, config["flask"], config)
+        counter = RequestCounter()
+        app.after_request(counter.after_request)
+        server = ServerThread(app=app, **config["flask"])
+        server.start()
+        try:
+            self.assertEqual(http.get(f"http://127.0.0.1:{PORT}/status").status_code, 200)
+            self.assertEqual(http.get(f"http://127.0.0.1:{PORT}/status/nothing").status_code, 404)
+        finally:
+            server.stop()
+            app.scheduler.stop()
+        self.assertEqual(
+            counter.metrics(),
+            {"requests": 2, "endpoints": {"metrics": 1, "status": 1}, "status": {"2xx": 1, "4xx": 1}},
+        )
+
+    def test_supervisor(self):
+        with TempDirectory() as temp:
+            config_file = temp / "config.json"
+            config_file.write(value2json({
+                "flask": {"host": "127.0.0.1", "port": SUPERVISOR_PORT, "threaded": True},
+                "supervisor": {"report_seconds": 0.2},
+                "scheduler": {"workers": 1},
+                "response_directory": (temp / "responses").abs_path,
+                "constants": {"spread_server": {"dispatch": {"DATA_DIRECTORY": "tests/resources"}}},
+                "debug": {"log": [{"log_type": "console"}]},
+            }))
+            supervisor = Supervisor(
+                params=[sys.executable, "-m", "spread_server.app", "--config", config_file.abs_path],
+                workers=2,
+                report_seconds=0.2,
+                restart_seconds=0.2,
+            )
+            try:
+                self._wait(lambda: all(w.metrics.get("pid") for w in supervisor.workers))
+                for _ in range(10):
+                    self.assertEqual(http.get(f"http://127.0.0.1:{SUPERVISOR_PORT}/status").status_code, 200)
+                self._wait(lambda: supervisor.metrics()["total"].get("requests") == 10)
+
+                dead = supervisor.workers[0]
+                dead_pid = dead.metrics["pid"]
+                dead_requests = dead.metrics["requests"]
+                dead.process.kill()
+                self._wait(lambda: dead.restarts == 1 and dead.metrics.get("pid") not in (None, dead_pid))
+
+                metrics = supervisor.metrics()
+                # THE DEAD WORKER'S COUNTS ARE KEPT
+                self.assertEqual(supervisor.retired.get("requests", 0), dead_requests)
+                self.assertEqual(metrics["total"]["requests"], 10)
+                self.assertEqual(metrics["workers"][0], {"num": 0, "alive": True, "restarts": 1, "requests": 0})
+                self.assertEqual(http.get(f"http://127.0.0.1:{SUPERVISOR_PORT}/status").status_code, 200)
+            finally:
+                supervisor.stop()
+            for worker in supervisor.workers:
+                self.assertTrue(worker.process.stopped)
+
+    def _wait(self, condition, seconds=60):
+        timeout = Till(seconds=seconds)
+        while not condition():
+            if timeout:
+                self.fail("timeout waiting for supervisor")
+            Till(seconds=0.1).wait()
+
+    def test_add(self):
+        total = {}
+        _add(total, {"pid": 1, "requests": 2, "status": {"2xx": 2}, "result_cache": {"hits": 1}})
+        _add(total, {"pid": 2, "requests": 3, "status": {"2xx": 1, "5xx": 2}})
+        self.assertEqual(total, {"requests": 5, "status": {"2xx": 3, "5xx": 2}, "result_cache": {"hits": 1}})
+        self.assertNotIn("pid", total)